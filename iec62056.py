@@ -4,9 +4,25 @@ import serial
 import threading
 import queue
 import time
-from datetime import datetime
+import bisect
+import random
+import json
+import signal
+import select
+import socket
+import struct
+try:
+    import fcntl
+    import termios
+except ImportError:#not posix, in_waiting of socket transports is not available
+    fcntl = None
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from pprint import pprint
 
+from iec62056_shm import iec62056_shm_writer, IEC_62056_SHM_DEFAULT_PATH
+
 
 import logging
 import os
@@ -225,31 +241,38 @@ def iec_62056_generate_acknowledge_option_select_message(protocol=0,mode=0,baudr
     return bytes(msg)
 
 def iec_62056_interpret_identification_message(msg):
+    """ @raise ValueError: if msg is no valid identification message, e.g. garbled on a noisy line """
     if msg[0:1] != IEC_62056_STARTCHARACTER:
-        raise NotImplementedError('Frame is corrupt SOF')
+        raise ValueError('Frame is corrupt SOF')
     if msg[-2:] != IEC_62056_COMPLETIONCHARACTER:
-        raise NotImplementedError('Frame is corrupt EOF')
-    manufacturer = msg[1:4].decode()
+        raise ValueError('Frame is corrupt EOF')
+    if len(msg) < 7:#/XXXZ CR LF
+        raise ValueError('Identification message {0} too short'.format(bytes(msg)))
+    manufacturer = msg[1:4].decode('ascii')#UnicodeDecodeError is a ValueError
+    if not manufacturer.isalpha():
+        raise ValueError('Invalid manufacturer {0} in identification message'.format(manufacturer))
     if manufacturer[2].isupper():
         reactiontime = 0.02 #20ms
     else:
         reactiontime = 0.2 #200ms
         
-    baudrate_character = msg[4:5].decode()
+    baudrate_character = msg[4:5].decode('ascii')
     if baudrate_character.isdigit():
         protocol_mode = 'C'
-        max_baudrate = IEC_62056_MODE_C_BAUDRATE_IDENTIFIERS[baudrate_character]
+        max_baudrate = IEC_62056_MODE_C_BAUDRATE_IDENTIFIERS.get(baudrate_character)
         baudrate_variable = True
     elif baudrate_character.isalpha():
         protocol_mode = 'B'
-        max_baudrate = IEC_62056_MODE_B_BAUDRATE_IDENTIFIERS[baudrate_character]
+        max_baudrate = IEC_62056_MODE_B_BAUDRATE_IDENTIFIERS.get(baudrate_character)
         baudrate_variable = True
     else:
         #print('Unknown Baudrate Character {0}'.format(baudrate_character)) ':' on DRS110M
         protocol_mode = 'A'
         max_baudrate = None
         baudrate_variable = False
-    identification = msg[5:-2].decode()
+    if max_baudrate is None and baudrate_variable:
+        raise ValueError('Unknown baudrate character {0} in identification message'.format(baudrate_character))
+    identification = msg[5:-2].decode('ascii')
     return {'manufacturer':manufacturer,
             'reactiontime':reactiontime,
             'max_baudrate':max_baudrate,
@@ -282,9 +305,14 @@ def iec_62056_interpret_data_message(msg):
 
 def iec_62056_interpret_obis_msg(msg):
     obis_data = {}
-    data = msg[msg.index(IEC_62056_STX)+1:msg.index(IEC_62056_ETX)]#STX to ETX
+    if IEC_62056_STX in msg:
+        data = msg[msg.index(IEC_62056_STX)+1:msg.index(IEC_62056_ETX)]#STX to ETX
+    else:
+        data = msg#unframed data block of mode D
     datalines = [x.decode() for x in data.split(IEC_62056_COMPLETIONCHARACTER) if x]
     for l in datalines:
+        if '(' not in l:
+            continue#end character ! of the data block
         line_elements = [x.rstrip(')') for x in l.split('(')]
         obis_code = line_elements[0]
         if len(line_elements) > 2:
@@ -298,6 +326,44 @@ def iec_62056_interpret_obis_msg(msg):
     
 
 
+def iec_62056_frame_length(buf):
+    """
+    delimit the first frame in a receive buffer by its protocol markers
+    @param buf: the receive buffer
+    @return: length of the first complete frame, 0 if it is incomplete,
+             for garbage in front of a frame the length up to the next start character
+    """
+    first = buf[0]
+    if first in (IEC_62056_ACK[0],IEC_62056_NACK[0]):
+        return 1
+    if first == IEC_62056_STARTCHARACTER[0]:
+        idx = buf.find(IEC_62056_COMPLETIONCHARACTER)
+        return idx+2 if idx >= 0 else 0
+    if first in (IEC_62056_STX[0],IEC_62056_SOH[0]):
+        for idx in range(1,len(buf)-1):#block end followed by bcc
+            if buf[idx] in (IEC_62056_ETX[0],IEC_62056_EOT[0]):
+                return idx+2
+        return 0
+    if buf[:2] == IEC_62056_COMPLETIONCHARACTER:#unframed data block after a mode D identification
+        idx = buf.find(IEC_62056_ENDCHARACTER+IEC_62056_COMPLETIONCHARACTER)
+        return idx+3 if idx >= 0 else 0
+    for idx in range(1,len(buf)):
+        if buf[idx] in (IEC_62056_STARTCHARACTER[0],IEC_62056_STX[0],IEC_62056_SOH[0],IEC_62056_ACK[0],IEC_62056_NACK[0]):
+            return idx
+    return 0
+
+
+def iec_62056_is_frame_start(buf):
+    """ @return: True if buf begins with the start marker of a frame that iec_62056_frame_length() can delimit """
+    return buf[:1] in (IEC_62056_STARTCHARACTER,IEC_62056_STX,IEC_62056_SOH) or buf[:2] == IEC_62056_COMPLETIONCHARACTER
+
+
+def iec_62056_character_time(baudrate,bytesize=7,parity='E',stopbits=1):
+    """ @return: the time on the line for one character in seconds """
+    bits = 1+bytesize+(0 if parity == 'N' else 1)+stopbits
+    return bits/baudrate
+
+
 def iec_62056_is_identification_message(msg):
     ret = True
     conds = [msg[0:1] == IEC_62056_STARTCHARACTER,#SOF
@@ -332,6 +398,16 @@ def iec_62056_is_data_message(msg):
         ret &= cond
     return ret 
 
+def iec_62056_is_data_block_message(msg):
+    """ unframed data block as pushed by mode D meters, CR LF data lines ! CR LF """
+    ret = True
+    conds = [msg[0:2] == IEC_62056_COMPLETIONCHARACTER,
+             msg[-3:] == IEC_62056_ENDCHARACTER+IEC_62056_COMPLETIONCHARACTER,
+             ]
+    for cond in conds:
+        ret &= cond
+    return ret
+
 def iec_62056_is_programming_command_message(msg):
     ret = True
     conds = [msg[0:1] == IEC_62056_SOH,
@@ -361,6 +437,14 @@ def iec_62056_generate_programming_command_message(cmd='R',cmd_type=1,data=None)
     msg.append(iec_62056_calc_bcc(msg))
     return bytes(msg)
     
+def iec_62056_generate_data_message(data):
+    msg = bytearray()
+    msg.extend(IEC_62056_STX)
+    msg.extend(data.encode())
+    msg.extend(IEC_62056_ETX)
+    msg.append(iec_62056_calc_bcc(msg))
+    return bytes(msg)
+    
 def iec_62056_generate_r1_message(address):
     data = '{0:08x}()'.format(address)
     msg = iec_62056_generate_programming_command_message(cmd='R',cmd_type=1,data=data)
@@ -420,13 +504,956 @@ def drs110m_fix_temperature_format(s):
     i = int(h,16)
     print(s,h,i)
     return i
-    
+
+
+class iec62056_register():
+    """ immutable compiled register description
+        built once from an entry of IEC_62056_REGISTERS and shared between all meters and threads
+    """
+    __slots__ = ('name','address','length','unit','scale','compu_method')
+
+    def __init__(self,name,address,length,unit='',scale='',compu_method=None):
+        object.__setattr__(self,'name',name)
+        object.__setattr__(self,'address',address)
+        object.__setattr__(self,'length',length)
+        object.__setattr__(self,'unit',unit)
+        object.__setattr__(self,'scale',scale)
+        object.__setattr__(self,'compu_method',compu_method)
+
+    def __setattr__(self,attr,val):
+        raise AttributeError('iec62056_register is immutable')
+
+    def __delattr__(self,attr):
+        raise AttributeError('iec62056_register is immutable')
+
+    def __repr__(self):
+        address = '0x{0:x}'.format(self.address) if self.address is not None else None#derived values have no address
+        return 'iec62056_register({0!r}, address={1}, length={2}, unit={3!r})'.format(self.name,address,self.length,self.unit)
+
+    def decode(self,val):
+        """ apply the compu method to the value string of a data message
+            @param val: the value string as found between the brackets
+            @return: the physical value
+        """
+        if self.compu_method:
+            return self.compu_method(val)
+        return val
+
+
+class iec62056_reading():
+    """ compact per-meter record of one register read
+        item access is kept so format_map(reading) works like it did with the register dicts
+    """
+    __slots__ = ('register','raw_data','value','time_stamp')
+
+    def __init__(self,register,raw_data=None,value=None,time_stamp=None):
+        self.register = register
+        self.raw_data = raw_data
+        self.value = value
+        self.time_stamp = time_stamp
+
+    @property
+    def name(self):
+        return self.register.name
+
+    @property
+    def address(self):
+        return self.register.address
+
+    @property
+    def unit(self):
+        return self.register.unit
+
+    @property
+    def scale(self):
+        return self.register.scale
+
+    def __getitem__(self,key):
+        try:
+            return getattr(self,key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return 'iec62056_reading({0!r}, value={1!r}, unit={2!r}, time_stamp={3!r})'.format(self.name,self.value,self.unit,self.time_stamp)
+
+
+class iec62056_register_map():
+    """ immutable compiled register map
+        name lookup for the user side and a dispatch table indexed by address for the decoding side
+    """
+    __slots__ = ('registers','_by_name','_by_address')
+
+    def __init__(self,reg_dict):
+        """
+        @param reg_dict: a dictionary in the layout of IEC_62056_REGISTERS or an iterable of iec62056_register
+        """
+        if isinstance(reg_dict,dict):
+            registers = tuple(iec62056_register(name=name,
+                                                address=reg['address'],
+                                                length=reg['length'],
+                                                unit=reg.get('unit',''),
+                                                scale=reg.get('scale',''),
+                                                compu_method=reg.get('compu_method')) for name,reg in reg_dict.items())
+        else:
+            registers = tuple(reg_dict)
+        by_address = [None]*(max([reg.address for reg in registers],default=-1)+1)
+        for reg in registers:
+            by_address[reg.address] = reg
+        object.__setattr__(self,'registers',registers)
+        object.__setattr__(self,'_by_name',dict((reg.name,reg) for reg in registers))
+        object.__setattr__(self,'_by_address',tuple(by_address))
+
+    def __setattr__(self,attr,val):
+        raise AttributeError('iec62056_register_map is immutable')
+
+    def __getitem__(self,name):
+        return self._by_name[name]
+
+    def __contains__(self,name):
+        return name in self._by_name
+
+    def __iter__(self):
+        return iter(self._by_name)
+
+    def __len__(self):
+        return len(self.registers)
+
+    def keys(self):
+        return self._by_name.keys()
+
+    def by_address(self,addr):
+        """ @return: the register for addr or None if unknown """
+        if 0 <= addr < len(self._by_address):
+            return self._by_address[addr]
+        return None
+
+    def subset(self,names):
+        """ @return: a new register map with only the registers in names """
+        return iec62056_register_map([self._by_name[name] for name in names])
+
+    def decode(self,msg):
+        """ decode a R1 data message by its address field without intermediate strings for the key
+            @param msg: the data message STX ADDRESS(VALUE) ETX BCC
+            @return: tuple of register (None if unknown) and the decoded value
+        """
+        idx = msg.index(b'(')
+        addr = int(msg[1:idx],16)
+        val = msg[idx+1:-2].decode().rstrip(')')
+        reg = self.by_address(addr)
+        if reg is None:
+            return None,val
+        return reg,reg.decode(val)
+
+
+IEC_62056_REGISTER_MAP = iec62056_register_map(IEC_62056_REGISTERS)
+
+
+IEC_62056_LATENCY_BUCKETS = (0.005,0.01,0.02,0.05,0.1,0.2,0.5,1,2,5,10)#upper bounds in seconds, last bucket is open
+
+
+class iec62056_histogram():
+    """ fixed bucket latency histogram """
+    __slots__ = ('bounds','counts','count','total','min','max')
+
+    def __init__(self,bounds=IEC_62056_LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0]*(len(self.bounds)+1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self,val):
+        self.counts[bisect.bisect_left(self.bounds,val)] += 1
+        self.count += 1
+        self.total += val
+        if self.min is None or val < self.min:
+            self.min = val
+        if self.max is None or val > self.max:
+            self.max = val
+        return
+
+    def percentile(self,p):
+        """ @return: the upper bound of the bucket containing the p-th percentile, max for the open bucket """
+        if not self.count:
+            return None
+        rank = p/100*self.count
+        seen = 0
+        for idx,cnt in enumerate(self.counts):
+            seen += cnt
+            if cnt and seen >= rank:
+                if idx < len(self.bounds):
+                    return min(self.bounds[idx],self.max)
+                return self.max
+        return self.max
+
+    def as_dict(self):
+        return {'count':self.count,
+                'total':self.total,
+                'mean':self.total/self.count if self.count else None,
+                'min':self.min,
+                'max':self.max,
+                'p50':self.percentile(50),
+                'p90':self.percentile(90),
+                'p99':self.percentile(99),
+                'buckets':dict(zip(self.bounds+(float('inf'),),self.counts)),
+                }
+
+
+class iec62056_meter_stats():
+    """ per meter session statistics, phase durations in histograms and event counters """
+    COUNTERS = ('retries','timeouts','bcc_failures','nacks','malformed_frames')
+
+    def __init__(self,meter,bounds=IEC_62056_LATENCY_BUCKETS):
+        self.meter = meter
+        self.bounds = bounds
+        self.phases = {}
+        self.counters = dict.fromkeys(self.COUNTERS,0)
+        self.lock = threading.Lock()
+
+    def record(self,phase,duration):
+        with self.lock:
+            hist = self.phases.get(phase)
+            if hist is None:
+                hist = iec62056_histogram(bounds=self.bounds)
+                self.phases.update({phase:hist})
+            hist.add(duration)
+        return
+
+    def count(self,counter,n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter,0)+n
+        return
+
+    def as_dict(self):
+        with self.lock:
+            return {'meter':self.meter,
+                    'counters':self.counters.copy(),
+                    'phases':dict((phase,hist.as_dict()) for phase,hist in self.phases.items()),
+                    }
+
+    def dump(self):
+        """ @return: the statistics as human readable text """
+        d = self.as_dict()
+        lines = ['Meter {0}'.format(d['meter'])]
+        lines.append('  '+' '.join(['{0}={1}'.format(k,v) for k,v in d['counters'].items()]))
+        lines.append('  {0:<24} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}'.format('phase','count','mean','min','p50','p99','max'))
+        for phase,h in sorted(d['phases'].items()):
+            lines.append('  {0:<24} {1:>6} {2:>9.4f} {3:>9.4f} {4:>9.4f} {5:>9.4f} {6:>9.4f}'.format(phase,h['count'],h['mean'],h['min'],h['p50'],h['p99'],h['max']))
+        return '\n'.join(lines)
+
+
+class iec62056_retry_policy():
+    """ bounded retransmission with exponential backoff and jitter """
+    def __init__(self,max_attempts=3,backoff=0.1,backoff_factor=2,max_backoff=2,jitter=0.5):
+        """
+        @param max_attempts: number of transmissions of a request including the first one
+        @param backoff: delay before the first retransmission in seconds
+        @param backoff_factor: multiplier of the delay for each further retransmission
+        @param max_backoff: upper limit of the delay in seconds
+        @param jitter: fraction of the delay that is randomized to keep meters on a bus from synchronizing
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self,attempt):
+        """ @return: the delay in seconds after the failed attempt number attempt (starting at 1) """
+        d = min(self.backoff*self.backoff_factor**(attempt-1),self.max_backoff)
+        return d*(1-self.jitter*random.random())
+
+
+class iec62056_circuit_breaker():
+    """ per meter circuit breaker
+        closed - requests pass, open - requests are skipped until the cooldown is over,
+        half_open - a single cheap probe decides between closed and open
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self,failure_threshold=3,cooldown=60):
+        """
+        @param failure_threshold: consecutive failed sessions to open the breaker
+        @param cooldown: seconds to skip the meter before probing it again
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ @return: True if a request may be sent to the meter """
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic()-self.opened_at < self.cooldown:
+                    return False
+                self.state = self.HALF_OPEN
+            return True
+
+    def is_probing(self):
+        return self.state == self.HALF_OPEN
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+        return
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    app_log.error('Circuit breaker opened after {0} failures'.format(self.failures))
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+        return
+
+
+
+class iec62056_metric():
+    """ declarative derived value computed from registers or other metrics
+        update() is O(1) per sample, a missing input yields None and leaves the state untouched
+    """
+    def __init__(self,name,inputs,unit=''):
+        """
+        @param name: name of the derived value
+        @param inputs: names of the registers or metrics this metric depends on
+        @param unit: unit of the derived value
+        """
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.unit = unit
+        self.register = iec62056_register(name=name,address=None,length=0,unit=unit)
+        self.value = None
+
+    def update(self,vals,time_stamp):
+        """
+        @param vals: the current input values in the order of inputs, None if missing
+        @param time_stamp: datetime of the sample
+        @return: the new value or None
+        """
+        if None in vals:
+            self.value = None
+        else:
+            self.value = self.compute(vals,time_stamp)
+        return self.value
+
+    def compute(self,vals,time_stamp):
+        raise NotImplementedError()
+
+
+class iec62056_metric_function(iec62056_metric):
+    """ stateless function of the inputs, e.g. a product or a ratio """
+    def __init__(self,name,inputs,func,unit=''):
+        super().__init__(name=name,inputs=inputs,unit=unit)
+        self.func = func
+
+    def compute(self,vals,time_stamp):
+        try:
+            return self.func(*vals)
+        except ZeroDivisionError:
+            return None
+
+
+class iec62056_metric_delta(iec62056_metric):
+    """ difference to the previous sample of a single input, e.g. consumed energy since the last poll """
+    def __init__(self,name,input_name,unit=''):
+        super().__init__(name=name,inputs=(input_name,),unit=unit)
+        self.last = None
+
+    def compute(self,vals,time_stamp):
+        cur = vals[0]
+        last,self.last = self.last,cur
+        if last is None:
+            return None
+        return cur-last
+
+
+class iec62056_metric_rate(iec62056_metric):
+    """ change per second of a single input times scale, e.g. Wh to W with scale 3600 """
+    def __init__(self,name,input_name,scale=1,unit=''):
+        super().__init__(name=name,inputs=(input_name,),unit=unit)
+        self.scale = scale
+        self.last = None
+        self.last_time_stamp = None
+
+    def compute(self,vals,time_stamp):
+        cur = vals[0]
+        last,last_time_stamp = self.last,self.last_time_stamp
+        self.last,self.last_time_stamp = cur,time_stamp
+        if last is None:
+            return None
+        dt = (time_stamp-last_time_stamp).total_seconds()
+        if dt <= 0:
+            return None
+        return (cur-last)*self.scale/dt
+
+
+class iec62056_metric_average(iec62056_metric):
+    """ rolling average over the last window samples with a running sum """
+    def __init__(self,name,input_name,window=10,unit=''):
+        super().__init__(name=name,inputs=(input_name,),unit=unit)
+        self.window = window
+        self.samples = deque()
+        self.sum = 0
+
+    def compute(self,vals,time_stamp):
+        cur = vals[0]
+        self.samples.append(cur)
+        self.sum += cur
+        if len(self.samples) > self.window:
+            self.sum -= self.samples.popleft()
+        return self.sum/len(self.samples)
+
+
+class iec62056_metric_ewma(iec62056_metric):
+    """ exponentially weighted moving average """
+    def __init__(self,name,input_name,alpha=0.1,unit=''):
+        super().__init__(name=name,inputs=(input_name,),unit=unit)
+        self.alpha = alpha
+        self.avg = None
+
+    def compute(self,vals,time_stamp):
+        cur = vals[0]
+        if self.avg is None:
+            self.avg = cur
+        else:
+            self.avg += self.alpha*(cur-self.avg)
+        return self.avg
+
+
+class iec62056_metric_daily(iec62056_metric):
+    """ per day counter of a single input, reset on the first sample of a new day
+        mode 'sum' accumulates the input (use it on a delta), 'max' and 'min' track the peak
+    """
+    def __init__(self,name,input_name,mode='sum',unit=''):
+        if mode not in ('sum','max','min'):
+            raise ValueError('Unknown mode {0}'.format(mode))
+        super().__init__(name=name,inputs=(input_name,),unit=unit)
+        self.mode = mode
+        self.day = None
+        self.acc = None
+
+    def compute(self,vals,time_stamp):
+        cur = vals[0]
+        day = time_stamp.date()
+        if day != self.day:
+            self.day = day
+            self.acc = cur
+        elif self.mode == 'sum':
+            self.acc += cur
+        elif self.mode == 'max':
+            self.acc = max(self.acc,cur)
+        else:
+            self.acc = min(self.acc,cur)
+        return self.acc
+
+
+class iec62056_metrics_engine():
+    """ evaluates derived metrics in dependency order on each new sample """
+    def __init__(self,metrics):
+        """
+        @param metrics: iterable of iec62056_metric, inputs that are no metric are taken from the sample
+        """
+        metrics = dict((m.name,m) for m in metrics)
+        order = []
+        state = {}#name -> 1 visiting, 2 done
+        def visit(name):
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                raise ValueError('Circular dependency on metric {0}'.format(name))
+            state[name] = 1
+            for dep in metrics[name].inputs:
+                if dep in metrics:
+                    visit(dep)
+            state[name] = 2
+            order.append(metrics[name])
+        for name in metrics:
+            visit(name)
+        self.metrics = tuple(order)
+
+    def update(self,values,time_stamp=None,time_stamps=None):
+        """
+        @param values: dictionary of input name to value, missing or None values are handled as missing
+        @param time_stamp: datetime of the sample, now if not given
+        @param time_stamps: dictionary of input name to the datetime the value was read,
+                            a metric is stamped with the latest time stamp of its inputs, time_stamp for inputs without
+        @return: dictionary of metric name to iec62056_reading
+        """
+        if time_stamp is None:
+            time_stamp = datetime.now()
+        values = dict(values)
+        stamps = dict(time_stamps or {})
+        ret = {}
+        for m in self.metrics:
+            ts = max([stamps.get(i) or time_stamp for i in m.inputs]) if m.inputs else time_stamp
+            v = m.update([values.get(i) for i in m.inputs],ts)
+            values[m.name] = v
+            stamps[m.name] = ts
+            ret[m.name] = iec62056_reading(register=m.register,value=v,time_stamp=ts if v is not None else None)
+        return ret
+
+
+def iec62056_select_metrics(metrics,available):
+    """ drop the metrics that can never be computed because an input is neither available nor another usable metric
+        @param metrics: iterable of iec62056_metric
+        @param available: names of the registers that are read
+        @return: list of the usable metrics
+    """
+    metrics = list(metrics)
+    known = set(available)
+    usable = []
+    changed = True
+    while changed:
+        changed = False
+        for m in metrics:
+            if m not in usable and all([i in known for i in m.inputs]):
+                usable.append(m)
+                known.add(m.name)
+                changed = True
+    return [m for m in metrics if m in usable]
+
+
+class iec62056_deadband():
+    """ reporting rule of one register
+        a value is reported if it moved more than absolute and more than relative times the last reported value,
+        i.e. the larger of both thresholds applies, the absolute one keeps small values near zero quiet,
+        the relative one large values, it is also reported if nothing was reported for heartbeat seconds,
+        non numeric values are reported on any change
+    """
+    __slots__ = ('absolute','relative','heartbeat')
+
+    def __init__(self,absolute=0,relative=None,heartbeat=None):
+        """
+        @param absolute: threshold in the unit of the register, 0 reports every change
+        @param relative: threshold as fraction of the last reported value, e.g. 0.01 for 1%
+        @param heartbeat: maximum silence in seconds, None for no heartbeat
+        """
+        self.absolute = absolute
+        self.relative = relative
+        self.heartbeat = heartbeat
+
+    def is_significant(self,last,value):
+        if last is None or value is None:
+            return last is not value
+        try:
+            diff = abs(value-last)
+        except TypeError:
+            return value != last
+        if isinstance(diff,timedelta):
+            return value != last
+        threshold = 0
+        if self.absolute is not None:
+            threshold = max(threshold,self.absolute)
+        if self.relative is not None:
+            threshold = max(threshold,self.relative*abs(last))
+        return diff > threshold
+
+
+DRS110M_DEADBANDS = {'Voltage':iec62056_deadband(absolute=1,heartbeat=900),
+                     'Current':iec62056_deadband(absolute=0.1,heartbeat=900),
+                     'Frequency':iec62056_deadband(absolute=0.1,heartbeat=900),
+                     'Active Power':iec62056_deadband(absolute=10,relative=0.02,heartbeat=900),
+                     'Reactive Power':iec62056_deadband(absolute=10,relative=0.02,heartbeat=900),
+                     'Apparent Power':iec62056_deadband(absolute=10,relative=0.02,heartbeat=900),
+                     'Serial Port':iec62056_deadband(heartbeat=86400),
+                     'Baudrate':iec62056_deadband(heartbeat=86400),
+                     'Meter ID':iec62056_deadband(heartbeat=86400),
+                     }
+
+
+class iec62056_change_filter():
+    """ suppresses readings that did not change significantly since they were last reported
+        sits between the poller and the outputs and keeps state per meter and register
+    """
+    def __init__(self,deadbands=None,default=None):
+        """
+        @param deadbands: dictionary of register name to iec62056_deadband
+        @param default: iec62056_deadband for registers not in deadbands, report on any change with a 900s heartbeat if not given
+        """
+        if deadbands is None:
+            deadbands = DRS110M_DEADBANDS
+        if default is None:
+            default = iec62056_deadband(absolute=0,heartbeat=900)
+        self.deadbands = dict(deadbands)
+        self.default = default
+        self.last = {}#(meter,name) -> (value,time_stamp) of the last report
+        self.lock = threading.Lock()
+
+    def should_report(self,meter,name,value,time_stamp):
+        """ @return: True if the value is to be reported, the filter state is updated in that case """
+        key = (meter,name)
+        db = self.deadbands.get(name,self.default)
+        with self.lock:
+            last = self.last.get(key)
+            if last is None:
+                report = True
+            else:
+                last_value,last_time_stamp = last
+                report = db.is_significant(last_value,value)
+                if not report and db.heartbeat is not None:
+                    report = (time_stamp-last_time_stamp).total_seconds() >= db.heartbeat
+            if report:
+                self.last[key] = (value,time_stamp)
+        return report
+
+    def filter(self,meter,readings,time_stamp=None):
+        """
+        @param meter: the meter the readings belong to
+        @param readings: dictionary of name to iec62056_reading (or None)
+        @param time_stamp: time of the poll, the reading time stamps or now if not given
+        @return: dictionary with the readings to report
+        """
+        now = datetime.now()
+        ret = {}
+        for name,reading in readings.items():
+            value = reading['value'] if reading is not None else None
+            ts = time_stamp or (reading['time_stamp'] if reading is not None else None) or now
+            if self.should_report(meter,name,value,ts):
+                ret[name] = reading
+        return ret
+
+    def reset(self,meter=None):
+        """ forget the state of meter or of all meters, the next readings are all reported """
+        with self.lock:
+            if meter is None:
+                self.last.clear()
+            else:
+                for key in [k for k in self.last if k[0] == meter]:
+                    del self.last[key]
+        return
+
+
+IEC_62056_MSG_DONTWAIT = getattr(socket,'MSG_DONTWAIT',0)#the sockets are non blocking anyway, this guards against a foreign setblocking()
+
+
+class iec62056_socket_transport():
+    """ serial port like transport over a connected socket
+        offers the part of the pyserial api that iec62056 uses, read() returns what is available up to n bytes
+        the socket is only replaced or closed under the lock, readers and writers work on their own reference
+        the socket is non blocking for its whole life, the rx thread and the session thread wait with select
+        and never change its mode, a blocking mode set by one thread would hang the other one in recv()
+    """
+    def __init__(self,sock=None,portsettings=None):
+        if portsettings is None:
+            portsettings = {}
+        self.baudrate = portsettings.get('baudrate',9600)
+        self.bytesize = portsettings.get('bytesize',serial.SEVENBITS)
+        self.parity = portsettings.get('parity',serial.PARITY_EVEN)
+        self.stopbits = portsettings.get('stopbits',serial.STOPBITS_ONE)
+        self.timeout = portsettings.get('timeout',0.1)
+        self.write_timeout = portsettings.get('write_timeout',5)
+        if sock is not None:
+            sock.setblocking(False)
+        self.sock = sock
+        self.is_open = sock is not None
+        self.lock = threading.RLock()
+
+    def isOpen(self):
+        return self.is_open
+
+    def fileno(self):
+        sock = self.sock
+        if sock is None:
+            raise ValueError('{0} is not connected'.format(self))
+        return sock.fileno()
+
+    @property
+    def in_waiting(self):
+        sock = self.sock
+        if fcntl is None or sock is None:
+            return 0
+        try:
+            return struct.unpack('I',fcntl.ioctl(sock.fileno(),termios.FIONREAD,b'\0\0\0\0'))[0]
+        except (OSError,ValueError):
+            return 0
+
+    def get_socket(self):
+        """ @return: the connected socket, a lost connection is restored first if possible
+            @raise ConnectionError: if there is no connection
+        """
+        sock = self.sock
+        if sock is None and self.is_open:
+            sock = self.on_connection_lost(None)
+        if sock is None or not self.is_open:
+            raise ConnectionError('{0} is not connected'.format(self))
+        return sock
+
+    def read(self,n=1):
+        try:
+            sock = self.get_socket()
+        except ConnectionError:
+            time.sleep(self.timeout or 0.1)#nothing to wait on, do not spin
+            return b''
+        try:
+            readable = select.select([sock],[],[],self.timeout)[0]
+            if not readable:
+                return b''
+            data = sock.recv(max(n,1),IEC_62056_MSG_DONTWAIT)
+        except BlockingIOError:#the other thread took it
+            return b''
+        except (OSError,ValueError):#ValueError from select on a socket closed meanwhile
+            data = b''
+        if not data and self.is_open:
+            self.on_connection_lost(sock)
+        return data
+
+    def send(self,sock,data):
+        """ sendall() for the non blocking socket
+            @raise OSError: if the socket fails or does not accept data within write_timeout
+        """
+        view = memoryview(data)
+        while view:
+            if not select.select([],[sock],[],self.write_timeout)[1]:
+                raise socket.timeout('Write timeout on {0}'.format(self))
+            try:
+                view = view[sock.send(view,IEC_62056_MSG_DONTWAIT):]
+            except BlockingIOError:
+                pass
+        return
+
+    def write(self,data):
+        """ @raise ConnectionError: if the connection is lost and could not be restored """
+        sock = self.get_socket()
+        try:
+            self.send(sock,data)
+        except (OSError,ValueError):
+            sock = self.on_connection_lost(sock)
+            if sock is None:
+                raise ConnectionError('Connection lost on {0}'.format(self))
+            try:
+                self.send(sock,data)
+            except (OSError,ValueError) as e:
+                raise ConnectionError('Connection lost on {0}'.format(self)) from e
+        return len(data)
+
+    def flushInput(self):
+        """ discard anything received so far """
+        sock = self.sock
+        if sock is None:
+            return
+        try:
+            while sock.recv(4096,IEC_62056_MSG_DONTWAIT):
+                pass
+        except OSError:#BlockingIOError when empty
+            pass
+        return
+
+    reset_input_buffer = flushInput
+
+    def on_connection_lost(self,sock):
+        """ called by the reader and the writer that noticed the loss of sock
+            @return: the socket to continue with or None
+        """
+        with self.lock:
+            if sock is not self.sock:#the other thread dealt with it already
+                return self.sock
+            app_log.error('Connection lost on {0}'.format(self))
+            self.close()
+        return None
+
+    def close(self):
+        with self.lock:
+            self.is_open = False
+            sock,self.sock = self.sock,None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        return
+
+
+class iec62056_loopback_transport(iec62056_socket_transport):
+    """ in memory transport, one end for iec62056 and the other one for a simulated bus """
+    @classmethod
+    def pair(cls,portsettings=None):
+        a,b = socket.socketpair()
+        return cls(sock=a,portsettings=portsettings),cls(sock=b,portsettings=portsettings)
+
+
+class iec62056_tcp_transport(iec62056_socket_transport):
+    """ raw tcp connection to an ethernet rs485 converter (ser2net style)
+        reconnects on connection loss and uses tcp keepalive to detect dead gateways,
+        close() hands the connection back to the pool it came from
+        during an outage reads and writes try one reconnect every reconnect_delay, writes raise ConnectionError
+    """
+    def __init__(self,host,port,portsettings=None,pool=None,connect_timeout=5,reconnect_delay=1,reconnect_attempts=3,keepalive=30):
+        """
+        @param reconnect_attempts: connection attempts right after a connection loss
+        """
+        super().__init__(sock=None,portsettings=portsettings)
+        self.host = host
+        self.port = port
+        self.pool = pool
+        self.connect_timeout = connect_timeout
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_attempts = reconnect_attempts
+        self.keepalive = keepalive
+        self.reconnects = 0
+        self.next_reconnect = 0
+        self.connect()
+
+    def __repr__(self):
+        return 'iec62056_tcp_transport({0}:{1})'.format(self.host,self.port)
+
+    def connect(self):
+        try:
+            sock = socket.create_connection((self.host,self.port),timeout=self.connect_timeout)
+        except OSError:
+            app_log.error('Could not connect to {0}:{1}'.format(self.host,self.port))
+            raise ValueError('Could not connect to {0}:{1}'.format(self.host,self.port))
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+        for opt,val in (('TCP_KEEPIDLE',self.keepalive),('TCP_KEEPINTVL',max(self.keepalive//3,1)),('TCP_KEEPCNT',3)):
+            if hasattr(socket,opt):
+                sock.setsockopt(socket.IPPROTO_TCP,getattr(socket,opt),val)
+        sock.setblocking(False)
+        with self.lock:
+            self.sock = sock
+            self.is_open = True
+        return
+
+    def is_alive(self):
+        """ @return: False if the peer closed the idle connection """
+        sock = self.sock
+        if sock is None:
+            return False
+        try:
+            return sock.recv(1,socket.MSG_PEEK | IEC_62056_MSG_DONTWAIT) != b''
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def on_connection_lost(self,sock):
+        """ reconnect, serialised between the reader and the writer
+            right after the loss up to reconnect_attempts, later one attempt every reconnect_delay
+            @param sock: the socket found broken, None if there was no connection
+            @return: the new socket or None if the gateway is unreachable
+        """
+        with self.lock:
+            if sock is not self.sock or not self.is_open:#reconnected by the other thread or closed meanwhile
+                return self.sock
+            if sock is not None:
+                app_log.error('Connection lost to {0}:{1} - reconnecting'.format(self.host,self.port))
+                self.sock = None
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+                attempts = self.reconnect_attempts
+            elif time.monotonic() < self.next_reconnect:
+                return None
+            else:
+                attempts = 1
+            for attempt in range(attempts):
+                try:
+                    self.connect()
+                    self.reconnects += 1
+                    return self.sock
+                except ValueError:
+                    if attempt+1 < attempts:
+                        time.sleep(self.reconnect_delay)
+            self.next_reconnect = time.monotonic()+self.reconnect_delay
+        return None
+
+    def close(self):
+        """ pooled connections only end the use, the socket stays open for the next acquire """
+        if self.pool is not None:
+            self.is_open = False
+            self.pool.release(self)
+        else:
+            super().close()
+        return
+
+
+class iec62056_tcp_pool():
+    """ keeps the tcp connections to the gateways open for reuse, one user per connection at a time """
+    def __init__(self):
+        self.connections = {}#(host,port) -> iec62056_tcp_transport
+        self.in_use = set()
+        self.lock = threading.Lock()
+
+    def acquire(self,host,port,portsettings=None):
+        key = (host,port)
+        with self.lock:
+            if key in self.in_use:
+                raise ValueError('Connection to {0}:{1} is in use'.format(host,port))
+            conn = self.connections.get(key)
+            if conn is not None and not conn.is_alive():
+                app_log.info('Pooled connection to {0}:{1} is dead - reconnecting'.format(host,port))
+                conn.is_open = True
+                conn.next_reconnect = 0
+                if conn.on_connection_lost(conn.sock) is None:
+                    conn.is_open = False
+                    raise ValueError('Could not connect to {0}:{1}'.format(host,port))
+            if conn is None:
+                conn = iec62056_tcp_transport(host=host,port=port,portsettings=portsettings,pool=self)
+                self.connections[key] = conn
+            elif portsettings:
+                conn.timeout = portsettings.get('timeout',conn.timeout)
+                conn.baudrate = portsettings.get('baudrate',conn.baudrate)
+            self.in_use.add(key)
+            conn.is_open = True
+        return conn
+
+    def release(self,conn):
+        with self.lock:
+            self.in_use.discard((conn.host,conn.port))
+        return
+
+    def close_all(self):
+        with self.lock:
+            conns = list(self.connections.values())
+            self.connections.clear()
+            self.in_use.clear()
+        for conn in conns:
+            conn.pool = None
+            conn.close()
+        return
+
+
+IEC_62056_TCP_POOL = iec62056_tcp_pool()
+
+
+def iec62056_open_transport(port,portsettings):
+    """
+    @param port: a device path for pyserial or tcp://host:port for a raw tcp serial server
+    @param portsettings: the port settings
+    @return: an opened transport with the pyserial api used by iec62056
+    """
+    if port.startswith('tcp://'):
+        host,_,tcp_port = port[len('tcp://'):].rpartition(':')
+        return IEC_62056_TCP_POOL.acquire(host=host,port=int(tcp_port),portsettings=portsettings)
+    try:
+        return serial.Serial(port=port,baudrate=portsettings['baudrate'],bytesize=portsettings['bytesize'],parity=portsettings['parity'],stopbits=portsettings['stopbits'],timeout=portsettings['timeout'])
+    except serial.SerialException:
+        app_log.error('SerialException - Could not open Serial Port {0}'.format(port))
+        raise ValueError('Could not open Serial Port {0}'.format(port))
 
 
 class iec62056():
     def __init__(self,port,portsettings=None):
         """
-        @param ser: Serial Connection, can be an serial.Serial object or a string to the port
+        @param port: Serial Connection, can be an serial.Serial object, a transport object,
+                     a string to the port or tcp://host:port for a raw tcp serial server
         """
         app_log.debug('Init with ser {0} ({1}), portsettings {2}'.format(port,type(port),portsettings))
         self.port = port
@@ -436,7 +1463,7 @@ class iec62056():
             self.portsettings = {}
         self.ser = None
         self.is_started = False
-        if self.port and self.portsettings:
+        if self.port and (self.portsettings or not isinstance(self.port,str)):
             self.configure_serial(port=self.port, portsettings=self.portsettings)
             
         
@@ -447,6 +1474,17 @@ class iec62056():
         self.programm_queue = queue.Queue()
         self.acknowledge_queue = queue.Queue()
         self.identification_queue = queue.Queue()
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.retry_policy = iec62056_retry_policy()
+        self.breakers = {}
+        self.breaker_settings = {'failure_threshold':3,
+                                 'cooldown':60}
+        self.pending_queue = None
+        
+        self.inter_character_timeout = None#derived from the baudrate if None
+        self.min_inter_character_timeout = 0.02#usb adapters deliver in packets, do not cut frames in between
+        self.frame_timeout = None#gap allowed within a recognised frame, the response timeout if None
         
         self.mutex = threading.Lock()
         self.device_lock = threading.Lock()
@@ -460,24 +1498,85 @@ class iec62056():
         app_log.info('Init Complete')
     
     def handlerx(self):
+        """ receive thread
+            frames are delivered as soon as their end marker arrives,
+            unrecognised bytes are delivered after an inter character timeout,
+            a frame whose start was recognised waits for its end marker until a gap of the frame timeout
+            as usb adapters and tcp links deliver in packets with gaps in between
+        """
         app_log.debug('handlerx started')
         rxbuff = bytearray()
+        failing = False
         while self.ser.isOpen():
-            msg = self.ser.read(64)
+            if not rxbuff:
+                timeout = 0.5
+            elif iec_62056_is_frame_start(rxbuff):
+                timeout = self.get_frame_timeout()
+            else:
+                timeout = self.get_inter_character_timeout()
+            try:
+                msg = self.read_available(timeout=timeout)
+            except (OSError,ValueError,TypeError,serial.SerialException) as e:
+                if not self.ser.isOpen():
+                    break
+                if not failing:#e.g. a transport replacing its socket, keep the thread alive
+                    app_log.error('Receive failed: {0}'.format(e))
+                failing = True
+                time.sleep(0.1)
+                continue
+            failing = False
             if msg:
                 app_log.debug('Serial Read {0}'.format(' '.join(['{0:02x}'.format(x) for x in msg])))
                 rxbuff.extend(msg)
-                if rxbuff[0] == IEC_62056_FRAMESTARTCHARACTER[0]:
-                    if rxbuff[-2] == IEC_62056_BLOCKENDCHARACTER[0]:
-                        self.on_iec62056_message(rxbuff)
-                        rxbuff = bytearray()
-                    else:
-                        #incomplete message
-                        pass
-                else:                                
-                    self.on_iec62056_message(rxbuff)
-                    rxbuff = bytearray()
+                while rxbuff:
+                    length = iec_62056_frame_length(rxbuff)
+                    if not length:
+                        break#incomplete message
+                    self.dispatch(rxbuff[:length])
+                    del rxbuff[:length]
+            elif rxbuff:
+                app_log.debug('Receive timeout with {0} bytes'.format(len(rxbuff)))
+                self.dispatch(rxbuff)
+                rxbuff = bytearray()
         return  
+
+    def dispatch(self,msg):
+        """ hand one received message to on_iec62056_message, a message that cannot be handled must not end the receive thread """
+        try:
+            self.on_iec62056_message(msg)
+        except Exception:
+            app_log.exception('Could not handle message {0}'.format(bytes(msg)))
+            self.meter_stats().count('malformed_frames')
+        return
+
+    def read_available(self,timeout):
+        """ wait up to timeout for the port to become readable and read whatever is waiting
+            ports without a file descriptor fall back to a blocking read with the port timeout
+        """
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError,OSError,ValueError):
+            fd = None
+        if fd is not None:
+            readable,_,_ = select.select([fd],[],[],timeout)
+            if not readable:
+                return b''
+        return self.ser.read(self.ser.in_waiting or 1)
+
+    def get_frame_timeout(self):
+        if self.frame_timeout is not None:
+            return self.frame_timeout
+        return self.timeout
+
+    def get_inter_character_timeout(self):
+        if self.inter_character_timeout is not None:
+            return self.inter_character_timeout
+        baudrate = getattr(self.ser,'baudrate',None) or self.portsettings.get('baudrate',300)
+        char_time = iec_62056_character_time(baudrate=baudrate,
+                                             bytesize=getattr(self.ser,'bytesize',7),
+                                             parity=getattr(self.ser,'parity','E'),
+                                             stopbits=getattr(self.ser,'stopbits',1))
+        return max(3.5*char_time,self.min_inter_character_timeout)
     
     
     def configure_serial(self,port=None,portsettings=None):
@@ -487,23 +1586,20 @@ class iec62056():
                 self.port=port
             if portsettings:
                 self.portsettings=portsettings
-            if self.port and self.portsettings:
+            if not isinstance(self.port,str):#an opened port or transport object
+                self.ser = self.port
+            elif self.port and self.portsettings:
                 if self.ser:
                     self.ser.close()
                     del self.ser
-                try:
-                    self.ser = serial.Serial(port=self.port,baudrate=self.portsettings['baudrate'],bytesize=self.portsettings['bytesize'],parity=self.portsettings['parity'],stopbits=self.portsettings['stopbits'],timeout=self.portsettings['timeout'])
-                except serial.SerialException:
-                    app_log.error('SerialException - Could not open Serial Port {0}'.format(port))
-                    raise ValueError('Could not open Serial Port {0}'.format(port))            
+                self.ser = iec62056_open_transport(port=self.port,portsettings=self.portsettings)
         return
     
 
     def change_baudrate_serial(self,baudrate):
         app_log.debug('Set Serial Baudrate {0}'.format(baudrate))
         #self.ser.setBaudrate(baudrate=baudrate) # not working any more
-        #self.ser.baudrate=baudrate <-- worked but seems nasty
-        self.ser.baudrate(baudrate)
+        self.ser.baudrate = baudrate#pyserial property, transports keep it for the inter character timeout
         app_log.debug('Baudrate now is {0}'.format(self.ser.baudrate))
         return
     
@@ -536,12 +1632,25 @@ class iec62056():
         elif iec_62056_is_programming_command_message(msg):
             app_log.debug('found programming message {0}'.format(msg))
             self.on_programming_message(msg)
+
+        elif iec_62056_is_nack_message(msg):
+            app_log.debug('found nack message {0}'.format(msg))
+            self.on_nack_message(msg)
+
+        elif iec_62056_is_data_block_message(msg):
+            app_log.debug('found data block message {0}'.format(msg))
+            self.data_queue.put(msg)
         else:
             print('No corresponding message {0}'.format(' '.join(['{0:02x}'.format(x) for x in msg])))    
         return
     
     def on_identification_message(self,msg):
-        md = iec_62056_interpret_identification_message(msg)
+        try:
+            md = iec_62056_interpret_identification_message(msg)
+        except ValueError as e:
+            app_log.error('Malformed identification message {0}: {1}'.format(bytes(msg),e))
+            self.meter_stats().count('malformed_frames')
+            return None
         with self.mutex:
             mi = md.pop('identification')
             md.update({'status':'initialized'})
@@ -553,32 +1662,157 @@ class iec62056():
     def on_data_message(self,msg):
         if iec_62056_check_bcc(msg):
             self.data_queue.put(msg)
+        else:
+            app_log.error('BCC failure on data message {0}'.format(msg))
+            self.meter_stats().count('bcc_failures')
         return
     
     def on_programming_message(self,msg):
         if iec_62056_check_bcc(msg):
             self.programm_queue.put(msg)
+        else:
+            app_log.error('BCC failure on programming message {0}'.format(msg))
+            self.meter_stats().count('bcc_failures')
         return
     
     def on_ack_message(self,msg):
         self.acknowledge_queue.put(msg)
         return        
+
+    def on_nack_message(self,msg):
+        """ a nack answers whatever request is pending, wake it up to repeat the request """
+        self.meter_stats().count('nacks')
+        pending_queue = self.pending_queue
+        if pending_queue is not None:
+            pending_queue.put(msg)
+        return
     
     
     def handletx(self):
+        """ transmit thread, blocks on txqueue until a message or the None sentinel from close() arrives
+            a failed write is handed to the pending request as exception
+        """
         app_log.debug('handletx started')
-        while self.ser.isOpen():
+        while True:
+            nexttxmessage = self.txqueue.get()
+            if nexttxmessage is None:
+                break
             try:
-                nexttxmessage = self.txqueue.get(1)
                 self.ser.write(nexttxmessage)
-                app_log.debug('Serial Write {0}'.format(' '.join(['{0:02x}'.format(x) for x in nexttxmessage])))
-            except queue.Empty:
-                pass
+            except (ConnectionError,OSError,serial.SerialException) as e:
+                app_log.error('Serial Write failed: {0}'.format(e))
+                pending = self.pending_queue
+                if pending is not None:
+                    pending.put(e)
+                continue
+            app_log.debug('Serial Write {0}'.format(' '.join(['{0:02x}'.format(x) for x in nexttxmessage])))
         return
     
     def transmit(self,msg):
         self.txqueue.put(msg)
         return
+
+    def close(self,timeout=2):
+        """ write out pending messages, stop the handler threads and close the port """
+        if self.is_started:
+            self.txqueue.put(None)
+            self.txhandler.join(timeout)
+        if self.ser:
+            self.ser.close()
+        if self.is_started:
+            self.rxhandler.join(timeout)
+        return
+
+    def meter_stats(self,device_address=None):
+        """ @return: the iec62056_meter_stats of device_address, the current meter if not given """
+        if device_address is None:
+            device_address = self.device_address
+        with self.stats_lock:
+            ms = self.stats.get(device_address)
+            if ms is None:
+                ms = iec62056_meter_stats(meter=device_address)
+                self.stats.update({device_address:ms})
+        return ms
+
+    @contextmanager
+    def measure(self,phase):
+        """ time a session phase of the current meter into its latency histogram """
+        ms = self.meter_stats()
+        t0 = time.perf_counter()
+        try:
+            yield ms
+        finally:
+            ms.record(phase,time.perf_counter()-t0)
+
+    def circuit_breaker(self,device_address=None):
+        """ @return: the iec62056_circuit_breaker of device_address, the current meter if not given """
+        if device_address is None:
+            device_address = self.device_address
+        with self.stats_lock:
+            cb = self.breakers.get(device_address)
+            if cb is None:
+                cb = iec62056_circuit_breaker(**self.breaker_settings)
+                self.breakers.update({device_address:cb})
+        return cb
+
+    def request(self,msg,resp_queue,max_attempts=None):
+        """ transmit msg and wait for the response on resp_queue according to the retry policy
+            a nack or a timeout leads to a retransmission after the backoff delay,
+            a failed write counts as failure of the meter's circuit breaker and raises ConnectionError
+            @param msg: the request message or a callable returning it, called right before each transmission
+            @param resp_queue: the queue the response is expected on
+            @param max_attempts: overrides the attempts of the retry policy
+            @return: the response message or None if all attempts failed
+            @raise ConnectionError: if the port could not transmit
+        """
+        policy = self.retry_policy
+        if max_attempts is None:
+            max_attempts = policy.max_attempts
+        ms = self.meter_stats()
+        resp = None
+        for attempt in range(1,max_attempts+1):
+            while not resp_queue.empty():#discard late answers to earlier requests
+                try:
+                    resp_queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.pending_queue = resp_queue
+            self.transmit(msg() if callable(msg) else msg)
+            try:
+                resp = resp_queue.get(timeout=self.timeout)
+            except queue.Empty:
+                resp = None
+                ms.count('timeouts')
+            finally:
+                self.pending_queue = None
+            if isinstance(resp,Exception):
+                self.circuit_breaker().failure()
+                raise ConnectionError('Transmission to {0} failed: {1}'.format(self.device_address,resp))
+            if resp is not None:
+                if not iec_62056_is_nack_message(resp):
+                    return resp
+                resp = None
+            if attempt < max_attempts:
+                ms.count('retries')
+                time.sleep(policy.delay(attempt))
+        return None
+
+    def get_stats(self,device_address=None):
+        """
+        @param device_address: the meter to get the statistics for, all meters if not given
+        @return: statistics as dictionary
+        """
+        if device_address is not None:
+            return self.meter_stats(device_address).as_dict()
+        with self.stats_lock:
+            meters = list(self.stats.values())
+        return dict((ms.meter,ms.as_dict()) for ms in meters)
+
+    def dump_stats(self):
+        """ @return: the statistics of all meters as human readable text """
+        with self.stats_lock:
+            meters = list(self.stats.values())
+        return '\n'.join([ms.dump() for ms in meters])
     
     def start_communication(self,device_address=None):
         app_log.info('start_communication to {0}'.format(device_address))
@@ -586,19 +1820,58 @@ class iec62056():
         if device_address == None:
             if self.device_address:
                 device_address = self.device_address
+        self.device_address = device_address
+        cb = self.circuit_breaker()
+        if not cb.allow():
+            app_log.info('Skipping {0} - circuit breaker open'.format(device_address))
+            raise ConnectionError('Circuit breaker open for {0}'.format(device_address))
         msg = iec_62056_generate_request_message(device_address)
-        self.transmit(msg)
-        resp = None
-        while not resp:
+        with self.measure('identification'):
+            resp = self.request(msg,self.identification_queue,max_attempts=1 if cb.is_probing() else None)
+        if resp is None:
+            app_log.error('Timeout on Start Communication message to {0}'.format(device_address))
+            cb.failure()
+            raise TimeoutError('No identification from {0}'.format(device_address))
+        return
+    
+    def drain_identifications(self,on_stale=None):
+        """ empty the identification queue
+            @param on_stale: callback on_stale(ident) for every interpreted identification found, they are dropped if not given
+        """
+        while True:
             try:
-                resp = self.identification_queue.get(timeout=self.timeout)
-                self.device_address = device_address
+                msg = self.identification_queue.get_nowait()
             except queue.Empty:
-                resp = None
-                app_log.error('Timeout on Start Communication message - next try')
-                self.transmit(msg)                          
+                break
+            if on_stale is not None and not isinstance(msg,Exception):
+                on_stale(iec_62056_interpret_identification_message(msg))
         return
-    
+
+    def identify(self,device_address,timeout=None,on_stale=None):
+        """ single identification exchange without retries and without the circuit breaker, used to probe for meters
+            @param device_address: the meter address to probe
+            @param timeout: seconds to wait for the identification after the request is transmitted, self.timeout if not given
+            @param on_stale: callback on_stale(ident) for late identifications that arrived before this request
+            @return: the interpreted identification message or None if nobody answered
+            @raise ConnectionError: if the port could not transmit
+        """
+        if timeout is None:
+            timeout = self.timeout
+        msg = iec_62056_generate_request_message(device_address)
+        self.drain_identifications(on_stale=on_stale)
+        char_time = iec_62056_character_time(baudrate=getattr(self.ser,'baudrate',None) or self.portsettings.get('baudrate',9600))
+        self.pending_queue = self.identification_queue
+        self.transmit(msg)
+        try:
+            resp = self.identification_queue.get(timeout=timeout+len(msg)*char_time)
+        except queue.Empty:
+            return None
+        finally:
+            self.pending_queue = None
+        if isinstance(resp,Exception):
+            raise ConnectionError('Transmission to {0} failed: {1}'.format(device_address,resp))
+        return iec_62056_interpret_identification_message(resp)
+
     def acknowledge_option_select(self,protocol=0,baudrate=None,mode=0):
         msg = iec_62056_generate_acknowledge_option_select_message(protocol=0, mode=mode,baudrate=baudrate)
         app_log.debug('sending ack_option_switch_message for protocol {0}, baudrate {1}, mode {2}'.format(protocol,baudrate,mode))
@@ -609,28 +1882,31 @@ class iec62056():
     def start_programming_mode_with_password(self,password=0):
         app_log.info('start_programming_mode_with_password {0}'.format(password))
         msg = iec_62056_generate_acknowledge_option_select_message(protocol=0, mode=1)
-        self.transmit(msg)
-        app_log.debug('ack_option_switch_message sent')
-        try:
-            self.programm_queue.get(timeout=self.timeout)
-            app_log.debug('password_request received')
-            msg = iec_62056_generate_p1_message(password)
-            self.transmit(msg)
-            app_log.debug('password_message sent')
-            self.acknowledge_queue.get(timeout=self.timeout)
-            app_log.debug('password_response received')
-        except queue.Empty:
+        with self.measure('option_select'):
+            resp = self.request(msg,self.programm_queue)
+        if resp is None:
+            app_log.error('Timeout on option select message')
+            self.circuit_breaker().failure()
+            raise TimeoutError('No password request from {0}'.format(self.device_address))
+        app_log.debug('password_request received')
+        msg = iec_62056_generate_p1_message(password)
+        with self.measure('password'):
+            resp = self.request(msg,self.acknowledge_queue)
+        if resp is None:
             app_log.error('Timeout on P1 message')
+            self.circuit_breaker().failure()
+            raise TimeoutError('Password not acknowledged by {0}'.format(self.device_address))
+        app_log.debug('password_response received')
+        self.circuit_breaker().success()#the session is established, earlier steps only count failures
         return
        
     def read_r1(self,addr):
         msg = iec_62056_generate_r1_message(addr)
-        self.transmit(msg)
-        try:
-            data = self.data_queue.get(timeout=self.timeout)
-        except queue.Empty:
-            data = None
-            app_log.error('No Response from Register {0}'.format(addr))        
+        reg = IEC_62056_REGISTER_MAP.by_address(addr)
+        with self.measure('R1 {0}'.format(reg.name if reg else '0x{0:02x}'.format(addr))):
+            data = self.request(msg,self.data_queue)
+        if data is None:
+            app_log.error('No Response from Register {0}'.format(addr))
         return data
     
 #     def simple_read_register(self,reg_address):
@@ -639,31 +1915,30 @@ class iec62056():
 #         return data
     
     def log_off(self):
+        """ the meter does not answer B0, so there is no latency to record for this phase """
         msg = iec_62056_generate_b0_message()
         self.transmit(msg)
         return 
     
     
-    def get_value_r1(self,valname,reg_dict=IEC_62056_REGISTERS):
-        """ usage simplification """
-        reg = reg_dict[valname]
-        reg.update({'raw_data':None,
-                    'value':None,
-                    })
-        addr = reg['address']
-        data = self.read_r1(addr=addr)
-        #print(valname,addr,data)
+    def get_value_r1(self,valname,reg_map=IEC_62056_REGISTER_MAP):
+        """ usage simplification
+            @param valname: the register name
+            @param reg_map: the compiled register map to look up valname
+            @return: a new iec62056_reading, the register map itself is never modified
+        """
+        reg = reg_map[valname]
+        reading = iec62056_reading(register=reg)
+        data = self.read_r1(addr=reg.address)
         if data:
-            reg.update({'raw_data':data})
-            key,val = iec_62056_interpret_data_message(data)
-            valaddr = int(key,16)
-            if valaddr != addr:
-                print('Protocol Error - expected{0} but found {1}'.format(addr,valaddr))
-            cm = reg['compu_method']
-            v = cm(val)
-            reg.update({'value':v})    
-            reg.update({'time_stamp':datetime.now()})    
-        return reg
+            reading.raw_data = data
+            valreg,v = reg_map.decode(data)
+            if valreg is not reg:
+                app_log.error('Protocol Error - expected {0} but found {1}'.format(reg.address,data))
+            else:
+                reading.value = v
+                reading.time_stamp = datetime.now()
+        return reading
     
 #     def print_value(self,valname):
 #         reg = self.get_value_r1(valname)
@@ -695,19 +1970,55 @@ class iec62056():
 #         app_log.debug('acknowledge received')
 #         return
     
+    def estimate_latency(self,msg_length):
+        """ estimate the time from handing a message to transmit() until the meter has received it completely
+            the transport latency is taken from the fastest password exchange of the current meter
+            @param msg_length: length of the message in bytes
+            @return: latency in seconds
+        """
+        char_time = iec_62056_character_time(baudrate=getattr(self.ser,'baudrate',None) or self.portsettings.get('baudrate',9600))
+        ms = self.meter_stats()
+        with ms.lock:
+            hist = ms.phases.get('password')
+            rtt = hist.min if hist else None
+        transport = 0
+        if rtt is not None:
+            p1_length = len(iec_62056_generate_p1_message(0))
+            transport = max((rtt-(p1_length+len(IEC_62056_ACK))*char_time)/2,0)
+        return transport+msg_length*char_time
+
     def write_w1(self,addr,val):
-        msg = iec_62056_generate_w1_message(address=addr,valuetowrite=val)
-        self.transmit(msg)
-        app_log.debug('write_w1 {0} {1}'.format(addr,val))
-        try:
-            self.acknowledge_queue.get(timeout=self.timeout)
-            app_log.debug('acknowledge received')
-        except queue.Empty:
-            app_log.debug('timeout while waiting for acknowledge')
-        return
+        """
+        @param val: the value string or a callable val(latency) returning it,
+                    called right before each transmission with the estimated latency to the meter
+        @return: True if the write was acknowledged
+        """
+        if callable(val):
+            latency = self.estimate_latency(len(iec_62056_generate_w1_message(address=addr,valuetowrite=val(0))))
+            def msg():
+                valuetowrite = val(latency)
+                app_log.debug('write_w1 {0} {1}'.format(addr,valuetowrite))
+                return iec_62056_generate_w1_message(address=addr,valuetowrite=valuetowrite)
+        else:
+            app_log.debug('write_w1 {0} {1}'.format(addr,val))
+            msg = iec_62056_generate_w1_message(address=addr,valuetowrite=val)
+        with self.measure('W1 0x{0:02x}'.format(addr)):
+            resp = self.request(msg,self.acknowledge_queue)
+        if resp is None:
+            app_log.error('timeout while waiting for acknowledge of W1 {0}'.format(addr))
+            return False
+        app_log.debug('acknowledge received')
+        return True
     
     def get_obis_data_frame(self):
-        msg = self.data_queue.get(timeout=5)
+        with self.measure('obis_block') as ms:
+            try:
+                msg = self.data_queue.get(timeout=5)
+            except queue.Empty:
+                ms.count('timeouts')
+                self.circuit_breaker().failure()
+                raise
+        self.circuit_breaker().success()
         obis_data = iec_62056_interpret_obis_msg(msg=msg)
         return obis_data
     
@@ -736,9 +2047,31 @@ class iec62056():
         return ret
     
 
+def drs110m_default_metrics(available=None):
+    """
+    @param available: names of the registers that are read, metrics on other registers are left out
+    @return: a fresh set of derived metrics for one drs110m
+    """
+    metrics = [iec62056_metric_function(name='calc_active_energy',inputs=('Voltage','Current'),func=lambda u,i:u*i,unit='W'),
+               iec62056_metric_function(name='Power Factor',inputs=('Active Power','Apparent Power'),func=lambda p,s:p/s),
+               iec62056_metric_delta(name='Active Energy Delta',input_name='Active Energy',unit='Wh'),
+               iec62056_metric_rate(name='Active Energy Rate',input_name='Active Energy',scale=3600,unit='W'),
+               iec62056_metric_ewma(name='Active Power EWMA',input_name='Active Power',alpha=0.1,unit='W'),
+               iec62056_metric_daily(name='Daily Active Energy',input_name='Active Energy Delta',mode='sum',unit='Wh'),
+               iec62056_metric_daily(name='Daily Peak Active Power',input_name='Active Power',mode='max',unit='W'),
+               ]
+    if available is not None:
+        metrics = iec62056_select_metrics(metrics,available)
+    return metrics
+
+
 class drs110m():
     """Protocol A fixed baudrate of 9600 """
-    def __init__(self,iec62056_dev,device_address,regs=None):
+    def __init__(self,iec62056_dev,device_address,regs=None,metrics=None):
+        """
+        @param regs: names of the registers to read, all if None
+        @param metrics: list of iec62056_metric to derive from the registers, drs110m_default_metrics() on regs if not given
+        """
         self.portsettings = {'baudrate':9600,
                              'bytesize':serial.SEVENBITS,
                              'parity':serial.PARITY_EVEN,
@@ -751,14 +2084,15 @@ class drs110m():
             self.iec62056_dev.start_serial()        
         self.device_address = device_address
         self.password = 0
-        if regs:
-            self.reg_dict = {}
-            for reg in regs:
-                self.reg_dict.update({reg:IEC_62056_REGISTERS[reg]})
+        if regs is not None:#an empty list for sessions that only write
+            self.reg_dict = IEC_62056_REGISTER_MAP.subset(regs)
         else:
-            self.reg_dict = IEC_62056_REGISTERS
+            self.reg_dict = IEC_62056_REGISTER_MAP
         self.reg_values = dict.fromkeys(self.reg_dict.keys())
-        
+        if metrics is None:
+            metrics = drs110m_default_metrics(available=self.reg_dict.keys())
+        self.metrics = iec62056_metrics_engine(metrics)
+
     def start_communication(self):
         self.iec62056_dev.start_communication(device_address=self.device_address)
         return
@@ -768,30 +2102,57 @@ class drs110m():
         return
     
     def update_values(self):
-        self.start_communication()
-        self.start_programming_mode()
-        for valname in self.reg_dict:
-            reg = self.iec62056_dev.get_value_r1(valname)
-            if reg['raw_data']:
-                self.reg_values.update({valname:reg})
-        #TODO: make this nice later
-        self.reg_values.update({"calc_active_energy":{"value":self.reg_values["Voltage"]["value"] * self.reg_values["Current"]["value"],
-                                                      "unit":"W"},
-                                })
-        self.log_off()
+        """ @return: True if the session took place, False if the meter did not answer or was skipped """
+        readings = {}
+        try:
+            self.start_communication()
+            self.start_programming_mode()
+            for valname in self.reg_dict:
+                reading = self.iec62056_dev.get_value_r1(valname,reg_map=self.reg_dict)
+                if reading.raw_data:
+                    self.reg_values.update({valname:reading})
+                if reading.value is not None:
+                    readings.update({valname:reading})
+            self.log_off()
+        except (TimeoutError,ConnectionError) as e:#a connection loss can happen anywhere in the session
+            app_log.error('update_values {0} failed: {1}'.format(self.device_address,e))
+            return False
+        self.update_metrics(readings=readings)
         return True
     
     def log_off(self):
         self.iec62056_dev.log_off()
         return
+
+    def get_stats(self):
+        return self.iec62056_dev.get_stats(device_address=self.device_address)
+
+    def update_metrics(self,readings,time_stamp=None):
+        """ feed the readings of one session into the derived metrics, registers that were not read count as missing
+            @param readings: dictionary of register name to iec62056_reading, rate metrics use their time stamps
+        """
+        values = dict((name,reading.value) for name,reading in readings.items())
+        time_stamps = dict((name,reading.time_stamp) for name,reading in readings.items())
+        self.reg_values.update(self.metrics.update(values,time_stamp=time_stamp,time_stamps=time_stamps))
+        return
     
     def get_value(self,valname):
         return {valname:self.reg_values[valname]}
+
+    def get_changed_values(self,change_filter):
+        """
+        @param change_filter: an iec62056_change_filter shared by the outputs
+        @return: the readings of the last update that are significant to report
+        """
+        return change_filter.filter(meter=self.device_address,readings=self.reg_values)
      
     
     def printstr_value(self,valname):
         val = self.get_value(valname)
-        val_as_str = '{value}{unit}'.format_map(val[valname])
+        if val[valname] is None or val[valname]['value'] is None:
+            val_as_str = 'None'
+        else:
+            val_as_str = '{value}{unit}'.format_map(val[valname])
         ret = '{0}:{1}'.format(valname, val_as_str)
         return ret
             
@@ -806,33 +2167,263 @@ class drs110m():
     def read_reg(self,addr):
         pass
     
-    def set_clock(self):
-        #TODO: change all functions not to do the 
+    def write_session(self,writes):
+        """ apply several W1 writes in one session
+            @param writes: list of tuples (addr,val), val may be a callable as in iec62056.write_w1
+            @return: list of bools, True for each acknowledged write
+        """
         self.start_communication()
-        self.start_programming_mode()
-        val = datetime_to_iec1107_time(datetime.now())
-        self.write_reg(addr=0x31, val=val)
-        #val2 = self.read_reg(addr=0x31)
-        #print(val,val2)
-        self.log_off()
+        try:
+            self.start_programming_mode()
+            acks = [self.write_reg(addr=addr,val=val) for addr,val in writes]
+        finally:
+            self.log_off()
+        return acks
+    
+    def set_clock(self):
+        return self.write_session([drs110m_clock_write()])
         
         
     def get_clock(self):
         pass
         
     def reset_energy(self):
-        self.start_communication()
-        self.start_programming_mode()
-        self.write_reg(addr=0x40, val="00000000")
-        self.log_off()
+        return self.write_session([(0x40,"00000000")])
         
     def set_temperature(self,t):#this is a stupid idea to figure out the temperature format used
-        self.start_communication()
-        self.start_programming_mode()
-        self.write_reg(addr=0x32, val="{0:04d}".format(t))
-        self.log_off()
+        return self.write_session([(0x32,"{0:04d}".format(t))])
                 
                 
+def drs110m_clock_write():
+    """ @return: W1 write of the clock, the time is taken at send time and advanced by the latency to the meter """
+    return (IEC_62056_REGISTER_MAP['Time'].address,lambda latency:datetime_to_iec1107_time(datetime.now()+timedelta(seconds=latency)))
+
+
+class drs110m_bulk_write_job():
+    """ applies a list of W1 writes to many meters on one bus, one session per meter """
+    def __init__(self,iec62056_dev,device_addresses,writes,password=0):
+        """
+        @param device_addresses: the meters to write to
+        @param writes: list of tuples (addr,val), see drs110m.write_session, e.g. [drs110m_clock_write()]
+        """
+        self.iec62056_dev = iec62056_dev
+        self.device_addresses = list(device_addresses)
+        self.writes = list(writes)
+        self.password = password
+        self.results = {}
+
+    def run(self):
+        """ @return: dictionary of device address to result dictionary with ok, acks, error and duration """
+        for device_address in self.device_addresses:
+            meter = drs110m(iec62056_dev=self.iec62056_dev,device_address=device_address,regs=[])
+            meter.password = self.password
+            t0 = time.perf_counter()
+            try:
+                acks = meter.write_session(self.writes)
+                error = None
+            except (TimeoutError,ConnectionError) as e:
+                acks = []
+                error = str(e)
+            ok = error is None and all(acks)
+            if not ok:
+                app_log.error('Bulk write to {0} failed acks {1} error {2}'.format(device_address,acks,error))
+            self.results[device_address] = {'ok':ok,
+                                            'acks':acks,
+                                            'error':error,
+                                            'duration':time.perf_counter()-t0,
+                                            }
+        return self.results
+
+    def report(self):
+        """ @return: the results as human readable text """
+        lines = []
+        for device_address,res in self.results.items():
+            lines.append('{0} {1} acks={2} {3:.3f}s {4}'.format(device_address,'ACK' if res['ok'] else 'FAIL',res['acks'],res['duration'],res['error'] or ''))
+        ok = sum([1 for res in self.results.values() if res['ok']])
+        lines.append('{0}/{1} meters ok'.format(ok,len(self.results)))
+        return '\n'.join(lines)
+
+
+def iec_62056_parse_address_spec(spec):
+    """ parse a list of meter addresses and address ranges
+        @param spec: string like "1613300150-1613300159,1613300200"
+        @return: list of addresses in the given order without duplicates
+    """
+    addresses = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first,last = [int(x) for x in part.split('-',1)]
+            if last < first:
+                raise ValueError('Empty address range {0}'.format(part))
+            addresses.extend(range(first,last+1))
+        else:
+            addresses.append(int(part))
+    return list(dict.fromkeys(addresses))
+
+
+def load_roster(path):
+    """ read a roster saved by drs110m_bus_discovery.save_roster
+        @return: the roster dictionary, an empty roster if the file does not exist
+    """
+    if not os.path.exists(path):
+        return {'port':None,'meters':[]}
+    with open(path) as f:
+        return json.load(f)
+
+
+IEC_62056_MAX_IDENTIFICATION_LENGTH = 23#/XXXZ, up to 16 characters of identification, CR LF
+
+
+class drs110m_bus_discovery():
+    """ finds the drs110m meters on a bus by probing candidate addresses
+        every candidate gets a single probe that waits for the reaction time of the meter and the time on the wire,
+        responders are confirmed by a second identification exchange with the regular timeout and logged off again
+        an identification arriving after its probe window is attributed by the address in its content,
+        without one all candidates probed within lookback seconds are confirmed
+    """
+    def __init__(self,iec62056_dev,reaction_time=0.2,confirm_timeout=None,lookback=1.5):
+        """
+        @param reaction_time: the longest time a meter takes to start its answer, 200ms for slow meters
+        @param confirm_timeout: seconds to wait on the confirmation of a responder, iec62056_dev.timeout if not given
+        @param lookback: seconds a late identification may be behind its probe, 1.5s is the maximum reaction time of the standard
+        """
+        self.portsettings = {'baudrate':9600,
+                             'bytesize':serial.SEVENBITS,
+                             'parity':serial.PARITY_EVEN,
+                             'stopbits':serial.STOPBITS_ONE,
+                             'timeout':0.1,
+                             }
+        self.iec62056_dev = iec62056_dev
+        if not self.iec62056_dev.is_started:
+            self.iec62056_dev.configure_serial(portsettings=self.portsettings)
+            self.iec62056_dev.start_serial()
+        self.reaction_time = reaction_time
+        self.confirm_timeout = confirm_timeout
+        self.lookback = lookback
+        self.meters = {}#address -> roster entry
+        self.rejected = set()#addresses that failed the confirmation
+        self.candidates = set()
+        self.recent = deque()#(probe time, address)
+        self.suspects = []#addresses to confirm
+        self.probes = 0
+
+    def get_probe_timeout(self):
+        """ @return: the reaction time plus the time on the wire of the longest identification and the receive latency """
+        dev = self.iec62056_dev
+        char_time = iec_62056_character_time(baudrate=getattr(dev.ser,'baudrate',None) or self.portsettings['baudrate'])
+        return self.reaction_time+IEC_62056_MAX_IDENTIFICATION_LENGTH*char_time+dev.get_inter_character_timeout()
+
+    def get_address(self,ident):
+        """ @return: the candidate address named in the identification or None """
+        digits = ''.join([c for c in ident['identification'] if c.isdigit()])
+        if digits and int(digits) in self.candidates:
+            return int(digits)
+        return None
+
+    def attribute(self,ident,received=None):
+        """ queue the candidates that may have sent a late identification for confirmation
+            @param received: monotonic time the identification arrived, now if not given
+        """
+        named = self.get_address(ident)
+        if named is not None:
+            self.suspects.append(named)
+            return
+        if received is None:
+            received = time.monotonic()
+        self.suspects.extend([addr for t,addr in reversed(self.recent) if 0 <= received-t <= self.lookback])
+        return
+
+    def probe(self,device_address,timeout):
+        dev = self.iec62056_dev
+        self.probes += 1
+        ident = dev.identify(device_address,timeout=timeout,on_stale=self.attribute)
+        if ident is not None:
+            dev.log_off()#the meter waits for the option select otherwise
+        return ident
+
+    def confirm(self,device_address):
+        """ @return: the roster entry of device_address or None if it does not answer again """
+        ident = self.probe(device_address,timeout=self.confirm_timeout)
+        named = self.get_address(ident) if ident is not None else None
+        if ident is None or named not in (None,device_address):
+            if ident is not None:#a late answer of another meter
+                self.suspects.append(named)
+            self.rejected.add(device_address)
+            return None
+        ident.update({'raw_data':bytes(ident['raw_data']).decode(errors='replace')})
+        entry = {'type':'drs110m',
+                 'address':device_address,
+                 'identification':ident,
+                 'discovered':datetime.now().isoformat(),
+                 }
+        self.meters.update({device_address:entry})
+        self.rejected.discard(device_address)
+        app_log.info('Discovered {0} {1}'.format(device_address,ident))
+        return entry
+
+    def confirm_suspects(self):
+        while self.suspects:
+            device_address = self.suspects.pop(0)
+            if device_address not in self.meters and device_address not in self.rejected:
+                self.confirm(device_address)
+        return
+
+    def discover(self,candidates,known=()):
+        """ probe all candidates, known addresses first
+            @param candidates: iterable of addresses, see iec_62056_parse_address_spec
+            @param known: addresses from an earlier roster, these are confirmed directly
+            @return: list of roster entries in the order found
+        """
+        t0 = time.perf_counter()
+        candidates = list(candidates)
+        self.candidates.update(candidates)
+        self.candidates.update(known)
+        for device_address in known:
+            if device_address not in self.meters:
+                self.confirm(device_address)
+        probe_timeout = self.get_probe_timeout()
+        for device_address in candidates:
+            if device_address in self.meters:
+                continue
+            sent = time.monotonic()
+            ident = self.probe(device_address,timeout=probe_timeout)
+            received = time.monotonic()
+            self.recent.append((sent,device_address))
+            while self.recent and received-self.recent[0][0] > self.lookback:
+                self.recent.popleft()
+            if ident is not None:
+                named = self.get_address(ident)
+                self.suspects.append(named if named is not None else device_address)
+                self.confirm_suspects()
+                if named is None and device_address not in self.meters:#a late answer of an earlier candidate
+                    self.attribute(ident,received=received)
+            self.confirm_suspects()
+        if self.recent:#answers to the last probes may still be on the way
+            time.sleep(max(self.lookback-(time.monotonic()-self.recent[-1][0]),0))
+            self.iec62056_dev.drain_identifications(on_stale=self.attribute)
+            self.confirm_suspects()
+        app_log.info('Discovery found {0} meters with {1} probes in {2:.1f}s'.format(len(self.meters),self.probes,time.perf_counter()-t0))
+        return list(self.meters.values())
+
+    def get_roster(self):
+        port = getattr(self.iec62056_dev,'port',None)
+        return {'port':port if isinstance(port,str) else None,
+                'updated':datetime.now().isoformat(),
+                'meters':sorted(self.meters.values(),key=lambda m:m['address']),
+                }
+
+    def save_roster(self,path):
+        """ store the roster as json, the meters list has the layout of the meters of a port in load_daemon_config """
+        tmp = '{0}.tmp'.format(path)
+        with open(tmp,'w') as f:
+            json.dump(self.get_roster(),f,indent=1)
+        os.replace(tmp,path)
+        return
+
+
 class pafal():
     
     """Protocol C variable baudrate of 300-?? """
@@ -868,13 +2459,286 @@ class pafal():
     
     def request_r1_180(self):
         return self.iec62056_dev.request_r1_180()
+
+    def get_stats(self):
+        return self.iec62056_dev.get_stats(device_address=self.device_address)
     
     
 
         
                 
     
-def selftest(port,cmd,meterid):  
+class iec62056_mode_d_listener():
+    """Protocol D fixed baudrate of 2400, the meter pushes identification and data block every few seconds
+       the listener never transmits
+    """
+    def __init__(self,iec62056_dev,on_telegram=None):
+        """
+        @param on_telegram: callback on_telegram(telegram) used by run()
+        """
+        self.portsettings = {'baudrate':2400,
+                             'bytesize':serial.SEVENBITS,
+                             'parity':serial.PARITY_EVEN,
+                             'stopbits':serial.STOPBITS_ONE,
+                             'timeout':0.1,
+                             }
+        self.iec62056_dev = iec62056_dev
+        if not self.iec62056_dev.is_started:
+            self.iec62056_dev.configure_serial(portsettings=self.portsettings)
+            self.iec62056_dev.start_serial()
+        self.on_telegram = on_telegram
+        self.device_address = None
+        self.telegram_timeout = 5#data block has to follow the identification within
+        self.stop_event = threading.Event()
+
+    def get_telegram(self,timeout=None):
+        """ wait for the next pushed telegram
+            @param timeout: seconds to wait for the identification, forever if None
+            @return: dictionary with identification data, obis_data and the receive time_stamp or None on timeout
+        """
+        dev = self.iec62056_dev
+        try:
+            ident = dev.identification_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        time_stamp = datetime.now()
+        with dev.measure('obis_block') as ms:
+            try:
+                msg = dev.data_queue.get(timeout=self.telegram_timeout)
+            except queue.Empty:
+                app_log.error('Identification {0} without data block'.format(ident))
+                ms.count('timeouts')
+                return None
+        try:
+            telegram = iec_62056_interpret_identification_message(ident)
+            obis_data = iec_62056_interpret_obis_msg(msg)
+        except ValueError as e:
+            app_log.error('Malformed telegram {0}: {1}'.format(bytes(ident+msg),e))
+            dev.meter_stats().count('malformed_frames')
+            return None
+        self.device_address = telegram['identification']
+        telegram.update({'obis_data':obis_data,
+                         'time_stamp':time_stamp,
+                         'raw_data':ident+msg,
+                         })
+        return telegram
+
+    def run(self):
+        """ pass every telegram to on_telegram until stop() is called """
+        while not self.stop_event.is_set():
+            telegram = self.get_telegram(timeout=0.5)
+            if telegram and self.on_telegram:
+                self.on_telegram(telegram)
+        return
+
+    def stop(self):
+        self.stop_event.set()
+        return
+
+
+def iec_62056_request_length(buf):
+    """ delimit the first request in a buffer as seen by a meter
+        @return: length of the first complete request, 0 if incomplete
+    """
+    first = buf[0]
+    if first in (IEC_62056_STARTCHARACTER[0],IEC_62056_ACK[0]):#request or option select, both end with CR LF
+        idx = buf.find(IEC_62056_COMPLETIONCHARACTER)
+        return idx+2 if idx >= 0 else 0
+    if first == IEC_62056_SOH[0]:
+        idx = buf.find(IEC_62056_ETX)
+        return idx+2 if 0 <= idx < len(buf)-1 else 0
+    return 1#line noise
+
+
+IEC_62056_JITTER_BUCKETS = (0.0001,0.0005,0.001,0.005,0.01,0.05,0.1,0.5,1,5)
+
+
+def load_daemon_config(path):
+    """ read the daemon configuration from a json file
+        {"report_interval":3600,
+         "shm":true,
+         "ports":[{"port":"/dev/ttyUSB0","interval":10,
+                   "meters":[{"type":"drs110m","address":1613300153,"regs":["Voltage","Active Power"]}]},
+                  {"port":"/dev/ttyUSB1","interval":60,
+                   "meters":[{"type":"pafal"}]}]}
+        a port serves one meter type as drs110m and pafal use different port settings
+        shm publishes the latest drs110m values for iec62056_shm_reader, true for the default path or a path
+        @param path: path to the json file
+        @return: the configuration dictionary
+    """
+    with open(path) as f:
+        config = json.load(f)
+    for port_cfg in config.get('ports',[]):
+        if not port_cfg.get('meters'):
+            raise ValueError('No meters configured for port {0}'.format(port_cfg.get('port')))
+    return config
+
+
+class iec62056_daemon():
+    """ long running poller
+        keeps the ports open, polls the meters of each port in its own thread on a drift free fixed cadence
+        and keeps jitter statistics of the poll cycles
+    """
+    def __init__(self,config,on_values=None,change_filter=None):
+        """
+        @param config: configuration dictionary, see load_daemon_config
+        @param on_values: callback on_values(meter,values) for each polled meter, print_values if not given
+        @param change_filter: optional iec62056_change_filter applied to drs110m values before on_values
+        """
+        self.config = config
+        self.on_values = on_values or self.print_values
+        self.change_filter = change_filter
+        self.report_interval = config.get('report_interval',3600)
+        self.shm_writer = None
+        self.stop_event = threading.Event()
+        self.buses = []
+        self.threads = []
+
+    def open_port(self,port_cfg):
+        return iec62056(port=port_cfg['port'])
+
+    def create_meter(self,dev,meter_cfg):
+        meter_type = meter_cfg.get('type','drs110m')
+        if meter_type == 'drs110m':
+            return drs110m(iec62056_dev=dev,device_address=meter_cfg['address'],regs=meter_cfg.get('regs'))
+        elif meter_type == 'pafal':
+            return pafal(iec62056_dev=dev,device_address=meter_cfg.get('address'))
+        raise ValueError('Unknown meter type {0}'.format(meter_type))
+
+    def setup(self):
+        shm = self.config.get('shm')
+        if shm:
+            self.shm_writer = iec62056_shm_writer(path=IEC_62056_SHM_DEFAULT_PATH if shm is True else shm,
+                                                  capacity=self.config.get('shm_capacity',1024))
+        for port_cfg in self.config['ports']:
+            dev = self.open_port(port_cfg)
+            meters = [self.create_meter(dev,meter_cfg) for meter_cfg in port_cfg['meters']]
+            self.buses.append({'port':port_cfg['port'],
+                               'dev':dev,
+                               'meters':meters,
+                               'interval':port_cfg.get('interval',10),
+                               'cycles':0,
+                               'overruns':0,
+                               'jitter':iec62056_histogram(bounds=IEC_62056_JITTER_BUCKETS),
+                               'cycle_time':iec62056_histogram(),
+                               })
+        return
+
+    def print_values(self,meter,values):
+        now = datetime.now()
+        for name,val in values.items():
+            if isinstance(val,iec62056_reading):
+                val = '{value}{unit}'.format_map(val)
+            print('{0} {1} {2}:{3}'.format(now,meter.device_address,name,val))
+        return
+
+    def poll_meter(self,meter):
+        if isinstance(meter,pafal):
+            values = meter.start_communication()
+            meter.iec62056_dev.log_off()
+        elif meter.update_values():
+            if self.shm_writer:
+                self.shm_writer.publish_readings(meter.device_address,meter.reg_values)
+            if self.change_filter:
+                values = meter.get_changed_values(self.change_filter)
+            else:
+                values = meter.reg_values
+        else:
+            values = {}
+        if values:
+            self.on_values(meter,values)
+        return
+
+    def run_bus(self,bus):
+        app_log.info('Polling {0} every {1}s'.format(bus['port'],bus['interval']))
+        interval = bus['interval']
+        t0 = time.monotonic()
+        last_report = t0
+        k = 0
+        while not self.stop_event.is_set():
+            scheduled = t0+k*interval
+            delay = scheduled-time.monotonic()
+            if delay > 0 and self.stop_event.wait(delay):
+                break
+            start = time.monotonic()
+            bus['jitter'].add(start-scheduled)
+            for meter in bus['meters']:
+                if self.stop_event.is_set():
+                    break
+                try:
+                    self.poll_meter(meter)
+                except Exception:
+                    app_log.exception('Polling {0} on {1} failed'.format(meter.device_address,bus['port']))
+            now = time.monotonic()
+            bus['cycle_time'].add(now-start)
+            bus['cycles'] += 1
+            k += 1
+            missed = int((now-t0)//interval)+1-k#slots that already passed while polling
+            if missed > 0:
+                bus['overruns'] += missed
+                app_log.error('Poll cycle on {0} overran by {1} slots'.format(bus['port'],missed))
+                k += missed
+            if self.report_interval and now-last_report >= self.report_interval:
+                last_report = now
+                app_log.info(self.dump_stats())
+        return
+
+    def run(self):
+        """ poll until stop() is called or SIGINT/SIGTERM is received """
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT,signal.SIGTERM):
+                signal.signal(sig,lambda signum,frame:self.stop())
+        self.setup()
+        for bus in self.buses:
+            t = threading.Thread(target=self.run_bus,args=(bus,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        while not self.stop_event.wait(1):
+            pass
+        for t in self.threads:
+            t.join()
+        self.shutdown()
+        return
+
+    def stop(self):
+        app_log.info('Daemon stop requested')
+        self.stop_event.set()
+        return
+
+    def shutdown(self):
+        """ log off all meters and close the ports """
+        for bus in self.buses:
+            dev = bus['dev']
+            for meter in bus['meters']:
+                dev.device_address = meter.device_address
+                dev.log_off()
+            dev.close()
+        if self.shm_writer:
+            self.shm_writer.close()
+        app_log.info(self.dump_stats())
+        return
+
+    def get_stats(self):
+        return dict((bus['port'],{'cycles':bus['cycles'],
+                                  'overruns':bus['overruns'],
+                                  'jitter':bus['jitter'].as_dict(),
+                                  'cycle_time':bus['cycle_time'].as_dict()}) for bus in self.buses)
+
+    def dump_stats(self):
+        lines = []
+        for port,st in self.get_stats().items():
+            j = st['jitter']
+            c = st['cycle_time']
+            if not j['count']:
+                lines.append('Port {0} no cycles'.format(port))
+                continue
+            lines.append('Port {0} cycles={1} overruns={2} jitter mean={3:.4f} p99={4:.4f} max={5:.4f} cycle mean={6:.4f} max={7:.4f}'.format(
+                         port,st['cycles'],st['overruns'],j['mean'],j['p99'],j['max'],c['mean'],c['max']))
+        return '\n'.join(lines)
+
+
+def selftest(port,cmd,meterid,stats=False,config=None,addresses=None,roster_path=None):  
     iec62056_obj = iec62056(port=port)    
     if cmd == 'readout_drs110m':        
         drs110m_dev = drs110m(iec62056_dev=iec62056_obj,
@@ -911,10 +2775,37 @@ def selftest(port,cmd,meterid):
                               )
         drs110m_dev.set_temperature(t=20)
         
+    elif cmd == 'drs110m_sync_clocks':
+        for port_cfg in load_daemon_config(config)['ports']:
+            addresses = [m['address'] for m in port_cfg['meters'] if m.get('type','drs110m') == 'drs110m']
+            dev = iec62056(port=port_cfg['port'])
+            try:
+                job = drs110m_bulk_write_job(iec62056_dev=dev,device_addresses=addresses,writes=[drs110m_clock_write()])
+                job.run()
+                print(job.report())
+            finally:
+                dev.close()
+
+    elif cmd == 'drs110m_discover':
+        roster = load_roster(roster_path) if roster_path else {'meters':[]}
+        discovery = drs110m_bus_discovery(iec62056_dev=iec62056_obj)
+        discovery.discover(candidates=iec_62056_parse_address_spec(addresses or str(meterid)),
+                           known=[m['address'] for m in roster['meters']])
+        if roster_path:
+            discovery.save_roster(roster_path)
+        pprint(discovery.get_roster())
+
+    elif cmd == 'listen_mode_d':
+        iec62056_mode_d_listener(iec62056_dev=iec62056_obj,on_telegram=pprint).run()
+
+    elif cmd == 'daemon':
+        iec62056_daemon(config=load_daemon_config(config),change_filter=iec62056_change_filter()).run()
+
     elif cmd == "test_temperature_correction":
         drs110m_fix_temperature_format("001;")
 
-        
+    if stats:
+        print(iec62056_obj.dump_stats())
 
     return        
     
@@ -927,10 +2818,19 @@ if __name__ == '__main__':
                       help="PORT device to use", metavar="PORT")  
     parser.add_option("-i", "--meterid", dest="meterid", type="int", default=1613300153,
                       help="METERID to start communication with", metavar="METERID")
+    parser.add_option("-s", "--stats", dest="stats", action="store_true", default=False,
+                      help="print session latency statistics after the command")
+    parser.add_option("-f", "--config", dest="config", default=None,
+                      help="CONFIG json file for the daemon command", metavar="CONFIG")
+    parser.add_option("-a", "--addresses", dest="addresses", default=None,
+                      help="ADDRESSES to probe by drs110m_discover, e.g. 1613300150-1613300159,1613300200", metavar="ADDRESSES")
+    parser.add_option("-r", "--roster", dest="roster", default=None,
+                      help="ROSTER json file of drs110m_discover, known meters are confirmed first", metavar="ROSTER")
     
     (options, args) = parser.parse_args()
  
-    selftest(port=options.port,cmd=options.command,meterid=options.meterid)
+    selftest(port=options.port,cmd=options.command,meterid=options.meterid,stats=options.stats,config=options.config,
+             addresses=options.addresses,roster_path=options.roster)
 
 
     
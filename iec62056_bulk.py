@@ -0,0 +1,196 @@
+# iec62056_bulk.py
+# Bulk decoding of recorded DRS110M R1 reply frames with numpy.
+# Frames have the layout STX ADDRESS(8 hex digits) ( VALUE ) ETX BCC
+import numpy as np
+
+from iec62056 import IEC_62056_STX, IEC_62056_ETX, IEC_62056_MODE_A_BAUDRATE_IDENTIFIERS, IEC_62056_REGISTER_MAP
+
+
+_STX = IEC_62056_STX[0]
+_ETX = IEC_62056_ETX[0]
+_OPEN = ord('(')
+_CLOSE = ord(')')
+_ADDRESS_LENGTH = 8
+
+_BAUDRATE_TABLE = np.full(max(IEC_62056_MODE_A_BAUDRATE_IDENTIFIERS)+1,np.nan)
+for _k,_v in IEC_62056_MODE_A_BAUDRATE_IDENTIFIERS.items():
+    _BAUDRATE_TABLE[_k] = _v
+
+
+def _lookup_baudrate(dec):
+    ret = np.full(dec.shape,np.nan)
+    ok = (dec >= 0) & (dec < len(_BAUDRATE_TABLE))
+    ret[ok] = _BAUDRATE_TABLE[dec[ok]]
+    return ret
+
+
+# vectorised counterparts of the compu methods in IEC_62056_REGISTERS, indexed by register address
+# each takes the value field as decimal integers and as hex nibbles (see drs110m_fix_temperature_format)
+IEC_62056_VECTOR_COMPU_METHODS = {
+                                  0x0:lambda dec,nib:dec/10,
+                                  0x1:lambda dec,nib:dec/10,
+                                  0x2:lambda dec,nib:dec/10,
+                                  0x3:lambda dec,nib:dec*10,
+                                  0x4:lambda dec,nib:dec*10,
+                                  0x5:lambda dec,nib:dec*10,
+                                  0x10:lambda dec,nib:dec,
+                                  0x32:lambda dec,nib:nib,
+                                  0x34:lambda dec,nib:dec,
+                                  0x35:lambda dec,nib:_lookup_baudrate(dec),
+                                  0x36:lambda dec,nib:dec,
+                                  }
+
+IEC_62056_TIME_ADDRESS = IEC_62056_REGISTER_MAP['Time'].address
+IEC_62056_NIBBLE_ADDRESSES = (IEC_62056_REGISTER_MAP['Temperature'].address,)#value characters 0x30-0x3F, see drs110m_fix_temperature_format
+
+
+def _as_buffer(data):
+    if isinstance(data,np.ndarray):
+        return np.ascontiguousarray(data,dtype=np.uint8).ravel()
+    if isinstance(data,(bytes,bytearray,memoryview)):
+        return np.frombuffer(data,dtype=np.uint8)
+    return np.frombuffer(b''.join(data),dtype=np.uint8)
+
+
+def iec_62056_bulk_find_frames(buf):
+    """ locate R1 reply frames in a buffer
+        a frame ends with ")" ETX BCC and starts at the last STX before that, anything in between frames is skipped
+        @param buf: numpy uint8 array
+        @return: tuple of arrays start (STX index), close (index of ")")
+    """
+    close = np.flatnonzero((buf[:-2] == _CLOSE) & (buf[1:-1] == _ETX))
+    stx = np.flatnonzero(buf == _STX)
+    idx = np.searchsorted(stx,close,side='right')-1
+    found = idx >= 0
+    close = close[found]
+    start = stx[idx[found]]
+    #a dropped ETX would make two frames share one STX, keep the later close only
+    keep = np.ones(len(start),dtype=bool)
+    keep[:-1] = start[1:] != start[:-1]
+    return start[keep],close[keep]
+
+
+def iec_62056_bulk_check_bcc(buf,start,end):
+    """ vectorised iec_62056_check_bcc for many frames at once via a prefix xor
+        @param buf: numpy uint8 array
+        @param start: index of the first byte of each frame (not part of the bcc)
+        @param end: index of the bcc byte of each frame
+        @return: boolean array
+    """
+    prefix = np.bitwise_xor.accumulate(buf)
+    return (prefix[end-1]^prefix[start]) == buf[end]
+
+
+def _digit_matrix(buf,first,lens):
+    width = int(lens.max()) if len(lens) else 0
+    cols = np.arange(width)
+    idx = np.minimum(first[:,None]+cols,len(buf)-1)
+    mask = cols < lens[:,None]
+    return buf[idx].astype(np.int64),mask
+
+
+def _horner(vals,mask,base):
+    acc = np.zeros(vals.shape[0],dtype=np.int64)
+    for k in range(vals.shape[1]):
+        acc = np.where(mask[:,k],acc*base+vals[:,k],acc)
+    return acc
+
+
+def _hex_values(chars):
+    lower = chars | 0x20
+    return np.where(chars <= ord('9'),chars-ord('0'),lower-ord('a')+10)
+
+
+def _is_hex(chars):
+    lower = chars | 0x20
+    return ((chars >= ord('0')) & (chars <= ord('9'))) | ((lower >= ord('a')) & (lower <= ord('f')))
+
+
+def _all_where(cond,mask,lens):
+    """ @return: True for rows with a non empty field where cond holds for every character """
+    return np.all(cond | ~mask,axis=1) & (lens > 0)
+
+
+def _decode_time(digits,lens):
+    """ YYMMDD0wHHMMSS as in iec1107_time_format to datetime64[s]
+        NaT where strptime would fail, i.e. non digits or a field out of range, nothing rolls over into the next month
+    """
+    ret = np.full(len(lens),np.datetime64('NaT'),dtype='datetime64[s]')
+    ok = lens == 14
+    if not ok.any():
+        return ret
+    d = digits[ok][:,:14]
+    two = lambda i:d[:,i]*10+d[:,i+1]
+    months = (2000+two(0)-1970)*12+two(2)-1
+    month_ok = (two(2) >= 1) & (two(2) <= 12)
+    months = np.where(month_ok,months,0)
+    first_day = months.astype('datetime64[M]').astype('datetime64[D]')
+    month_length = ((months+1).astype('datetime64[M]').astype('datetime64[D]')-first_day).astype(np.int64)
+    in_range = (np.all((d >= 0) & (d <= 9),axis=1) & month_ok
+                & (two(4) >= 1) & (two(4) <= month_length)
+                & (d[:,6] == 0) & (d[:,7] <= 6)#0 and the week day %w
+                & (two(8) <= 23) & (two(10) <= 59) & (two(12) <= 59))
+    days = first_day+(two(4)-1)
+    values = days.astype('datetime64[s]')+(two(8)*3600+two(10)*60+two(12))
+    ret[np.flatnonzero(ok)[in_range]] = values[in_range]
+    return ret
+
+
+def iec_62056_bulk_decode_r1(data,compu_methods=IEC_62056_VECTOR_COMPU_METHODS):
+    """ decode a large amount of recorded R1 reply frames at once
+        @param data: a buffer of concatenated frames (bytes, bytearray, memoryview, numpy uint8 array)
+                     or an iterable of single frames
+        @param compu_methods: vectorised compu methods indexed by register address
+        @return: dictionary of columns, one row per frame found
+                 start - offset of the frame in the buffer
+                 length - length of the frame
+                 bcc_valid - the frame checksum is correct
+                 valid - bcc, layout and address are ok and the value field is well formed,
+                         i.e. IEC_62056_REGISTER_MAP.decode would decode it without an error
+                 address - register address
+                 value - physical value as float, nan where not applicable
+                 time - datetime64[s] value of the Time register, NaT elsewhere
+    """
+    buf = _as_buffer(data)
+    if len(buf) < 3:
+        start = close = np.zeros(0,dtype=np.int64)
+    else:
+        start,close = iec_62056_bulk_find_frames(buf)
+    end = close+2
+    bcc_valid = iec_62056_bulk_check_bcc(buf,start,end)
+
+    addr_chars = buf[np.minimum(start[:,None]+1+np.arange(_ADDRESS_LENGTH),len(buf)-1)].astype(np.int64)
+    address = _horner(_hex_values(addr_chars),np.ones(addr_chars.shape,dtype=bool),16)
+    layout_ok = (buf[np.minimum(start+1+_ADDRESS_LENGTH,len(buf)-1)] == _OPEN) & np.all(_is_hex(addr_chars),axis=1)
+
+    first = start+2+_ADDRESS_LENGTH
+    lens = np.maximum(close-first,0)
+    chars,mask = _digit_matrix(buf,first,lens)
+    digits = chars-ord('0')#ascii digits, beyond 9 on the drs110m temperature
+    is_digit = (digits >= 0) & (digits <= 9)
+    decimal_ok = _all_where(is_digit,mask,lens)
+    nibble_ok = _all_where((digits >= 0) & (digits <= 0xF),mask,lens)
+    dec = _horner(np.where(is_digit,digits,0),mask,10)
+    nib = _horner(digits & 0xF,mask,16)
+
+    value = np.full(len(start),np.nan)
+    time = np.full(len(start),np.datetime64('NaT'),dtype='datetime64[s]')
+    known = np.zeros(len(start),dtype=bool)
+    good = bcc_valid & layout_ok
+    for addr in np.unique(address[good]):
+        sel = good & (address == addr)
+        if addr == IEC_62056_TIME_ADDRESS:
+            time[sel] = _decode_time(digits[sel],lens[sel])
+            known[sel] = ~np.isnat(time[sel])
+        elif addr in compu_methods:
+            sel &= nibble_ok if addr in IEC_62056_NIBBLE_ADDRESSES else decimal_ok
+            value[sel] = compu_methods[addr](dec[sel],nib[sel])
+            known[sel] = ~np.isnan(value[sel])
+    return {'start':start,
+            'length':end-start+1,
+            'bcc_valid':bcc_valid,
+            'valid':good & known,
+            'address':address,
+            'value':value,
+            'time':time,
+            }
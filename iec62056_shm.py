@@ -0,0 +1,240 @@
+# iec62056_shm.py
+# Latest values of all meters in a memory mapped table for local readers.
+# One writer (the poller), any number of readers, each slot is protected by a sequence counter (seqlock).
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+from tempfile import gettempdir
+
+
+IEC_62056_SHM_MAGIC = b'IEC62056'
+IEC_62056_SHM_VERSION = 2
+IEC_62056_SHM_HEADER = struct.Struct('<8sIIIII')#magic, version, capacity, used slots, slot size, generation
+IEC_62056_SHM_HEADER_SIZE = 64
+IEC_62056_SHM_SLOT = struct.Struct('<QddII32s48s16s')#seq, value, time stamp, flags, reserved, meter, register, unit
+IEC_62056_SHM_SEQ = struct.Struct('<Q')
+IEC_62056_SHM_DATA = struct.Struct('<dd')
+IEC_62056_SHM_DATA_OFFSET = 8
+IEC_62056_SHM_CAPACITY_OFFSET = 12
+IEC_62056_SHM_USED_OFFSET = 16
+IEC_62056_SHM_GENERATION_OFFSET = 24
+IEC_62056_SHM_UINT = struct.Struct('<I')
+
+if os.path.isdir('/dev/shm'):
+    IEC_62056_SHM_DEFAULT_PATH = '/dev/shm/iec62056_values'
+else:
+    IEC_62056_SHM_DEFAULT_PATH = os.path.join(gettempdir(),'iec62056_values')
+
+
+def _slot_offset(idx):
+    return IEC_62056_SHM_HEADER_SIZE+idx*IEC_62056_SHM_SLOT.size
+
+
+def _as_number(value):
+    if isinstance(value,bool):
+        return float(value)
+    if isinstance(value,(int,float)):
+        return float(value)
+    if isinstance(value,datetime):
+        return value.timestamp()
+    return None
+
+
+class iec62056_shm_writer():
+    """ publishes the latest value of every meter and register into the table
+        one writer may be shared by the poll threads of several buses, slot allocation and updates are serialised
+    """
+    def __init__(self,path=IEC_62056_SHM_DEFAULT_PATH,capacity=1024):
+        """
+        @param path: the file to map, on /dev/shm it never touches a disk
+        @param capacity: number of meter/register slots
+        """
+        self.path = path
+        self.capacity = capacity
+        self.fd = os.open(path,os.O_RDWR | os.O_CREAT,0o644)#no O_TRUNC, readers of a previous run may still map the file
+        self.generation = self.get_previous_generation()+1
+        size = max(_slot_offset(capacity),os.fstat(self.fd).st_size)#never shrink the file under a reader
+        os.ftruncate(self.fd,size)
+        self.mm = mmap.mmap(self.fd,size)
+        #announce the new generation first so attached readers drop their slot indices before the slots are reused
+        IEC_62056_SHM_UINT.pack_into(self.mm,IEC_62056_SHM_USED_OFFSET,0)
+        IEC_62056_SHM_UINT.pack_into(self.mm,IEC_62056_SHM_GENERATION_OFFSET,self.generation)
+        self.mm[IEC_62056_SHM_HEADER_SIZE:size] = bytes(size-IEC_62056_SHM_HEADER_SIZE)
+        IEC_62056_SHM_HEADER.pack_into(self.mm,0,IEC_62056_SHM_MAGIC,IEC_62056_SHM_VERSION,capacity,0,IEC_62056_SHM_SLOT.size,self.generation)
+        self.slots = {}#(meter,register) -> index
+        self.seqs = []
+        self.lock = threading.Lock()#the seqlock of a slot allows a single writer only
+
+    def get_previous_generation(self):
+        """ @return: the generation of the table a previous writer left in the file, 0 if there is none """
+        header = os.pread(self.fd,IEC_62056_SHM_HEADER.size,0)
+        if len(header) < IEC_62056_SHM_HEADER.size:
+            return 0
+        magic,version,capacity,used,slot_size,generation = IEC_62056_SHM_HEADER.unpack(header)
+        if magic != IEC_62056_SHM_MAGIC:
+            return 0
+        return generation
+
+    def slot(self,meter,register,unit=''):
+        """ @return: the slot index of meter and register, allocated on first use """
+        key = (str(meter),register)
+        idx = self.slots.get(key)
+        if idx is None:
+            with self.lock:
+                idx = self.allocate_slot(key,unit)
+        return idx
+
+    def allocate_slot(self,key,unit):
+        idx = self.slots.get(key)#another thread may have allocated it meanwhile
+        if idx is None:
+            idx = len(self.slots)
+            if idx >= self.capacity:
+                raise ValueError('Shared memory table is full with {0} slots'.format(self.capacity))
+            IEC_62056_SHM_SLOT.pack_into(self.mm,_slot_offset(idx),0,float('nan'),0.0,0,0,
+                                         key[0].encode()[:32],key[1].encode()[:48],(unit or '').encode()[:16])
+            self.seqs.append(0)
+            self.slots[key] = idx
+            IEC_62056_SHM_UINT.pack_into(self.mm,IEC_62056_SHM_USED_OFFSET,idx+1)#publish the slot after it is complete
+        return idx
+
+    def write_slot(self,idx,value,time_stamp):
+        off = _slot_offset(idx)
+        with self.lock:
+            seq = self.seqs[idx]+1
+            IEC_62056_SHM_SEQ.pack_into(self.mm,off,seq)#odd, write in progress
+            IEC_62056_SHM_DATA.pack_into(self.mm,off+IEC_62056_SHM_DATA_OFFSET,value,time_stamp)
+            seq += 1
+            IEC_62056_SHM_SEQ.pack_into(self.mm,off,seq)
+            self.seqs[idx] = seq
+        return
+
+    def publish(self,meter,register,value,time_stamp=None,unit=''):
+        """ write one value, non numeric values except datetime are ignored
+            @return: True if the value was written
+        """
+        value = _as_number(value)
+        if value is None:
+            return False
+        if time_stamp is None:
+            time_stamp = time.time()
+        elif isinstance(time_stamp,datetime):
+            time_stamp = time_stamp.timestamp()
+        self.write_slot(self.slot(meter,register,unit),value,time_stamp)
+        return True
+
+    def publish_readings(self,meter,readings):
+        """ @param readings: dictionary of name to iec62056_reading as in drs110m.reg_values """
+        for name,reading in readings.items():
+            if reading is not None and reading['value'] is not None:
+                self.publish(meter,name,reading['value'],time_stamp=reading['time_stamp'],unit=reading['unit'])
+        return
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+        return
+
+
+class iec62056_shm_reader():
+    """ maps the table read only and looks up slots by meter and register name
+        a restarted writer allocates the slots anew, the reader notices the new generation and learns them again
+    """
+    def __init__(self,path=IEC_62056_SHM_DEFAULT_PATH):
+        self.path = path
+        self.fd = os.open(path,os.O_RDONLY)
+        self.mm = mmap.mmap(self.fd,0,prot=mmap.PROT_READ)
+        magic,version,capacity,used,slot_size,generation = IEC_62056_SHM_HEADER.unpack_from(self.mm,0)
+        if magic != IEC_62056_SHM_MAGIC or version != IEC_62056_SHM_VERSION or slot_size != IEC_62056_SHM_SLOT.size:
+            raise ValueError('{0} is no iec62056 table'.format(path))
+        self.capacity = capacity
+        self.generation = generation
+        self.slots = {}
+        self.known = 0
+
+    def get_generation(self):
+        return IEC_62056_SHM_UINT.unpack_from(self.mm,IEC_62056_SHM_GENERATION_OFFSET)[0]
+
+    def reset(self,generation):
+        """ forget all slots of the previous generation, remap if the new writer grew the file """
+        self.slots = {}
+        self.known = 0
+        self.generation = generation
+        if os.fstat(self.fd).st_size != len(self.mm):
+            self.mm.close()
+            self.mm = mmap.mmap(self.fd,0,prot=mmap.PROT_READ)
+        self.capacity = IEC_62056_SHM_UINT.unpack_from(self.mm,IEC_62056_SHM_CAPACITY_OFFSET)[0]
+        return
+
+    def refresh(self):
+        """ learn the slots the writer added since the last call """
+        generation = self.get_generation()
+        if generation != self.generation:
+            self.reset(generation)
+        used = IEC_62056_SHM_UINT.unpack_from(self.mm,IEC_62056_SHM_USED_OFFSET)[0]
+        for idx in range(self.known,used):
+            _,_,_,_,_,meter,register,unit = IEC_62056_SHM_SLOT.unpack_from(self.mm,_slot_offset(idx))
+            self.slots[(meter.rstrip(b'\0').decode(),register.rstrip(b'\0').decode())] = idx
+        self.known = used
+        return
+
+    def slot(self,meter,register):
+        """ @return: the slot index to pass to read_slot() or None if the writer did not publish it yet """
+        key = (str(meter),register)
+        if self.get_generation() != self.generation:
+            self.refresh()
+        idx = self.slots.get(key)
+        if idx is None:
+            self.refresh()
+            idx = self.slots.get(key)
+        return idx
+
+    def read_slot(self,idx,retries=100):
+        """ consistent read of one slot
+            @return: tuple of value, unix time stamp and sequence number
+                     or None if the writer restarted since the index was looked up, look it up again with slot()
+        """
+        off = _slot_offset(idx)
+        for _ in range(retries):
+            seq = IEC_62056_SHM_SEQ.unpack_from(self.mm,off)[0]
+            if seq & 1:
+                continue
+            value,time_stamp = IEC_62056_SHM_DATA.unpack_from(self.mm,off+IEC_62056_SHM_DATA_OFFSET)
+            if IEC_62056_SHM_SEQ.unpack_from(self.mm,off)[0] == seq:
+                #the writer announces a new generation before it reuses any slot
+                if self.get_generation() != self.generation:
+                    return None
+                return value,time_stamp,seq
+        raise TimeoutError('Slot {0} is being written continuously'.format(idx))
+
+    def get(self,meter,register,retries=3):
+        """ @return: tuple of value, unix time stamp and sequence number or None if not published """
+        for _ in range(retries):
+            idx = self.slot(meter,register)
+            if idx is None:
+                return None
+            result = self.read_slot(idx)
+            if result is not None:
+                return result
+        return None
+
+    def get_all(self):
+        """ @return: dictionary of (meter,register) to tuple of value, time stamp, sequence number """
+        values = {}
+        while True:
+            self.refresh()
+            values.clear()
+            for key,idx in list(self.slots.items()):
+                result = self.read_slot(idx)
+                if result is None:#writer restarted, what was read so far belongs to the old table
+                    break
+                values.update({key:result})
+            else:
+                return values
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+        return
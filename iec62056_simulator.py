@@ -0,0 +1,205 @@
+# iec62056_simulator.py
+# Simulated DRS110M meters on a virtual multi drop bus and a raw tcp serial server stand-in,
+# to run iec62056 without hardware in tests and in the soak test.
+import random
+import socket
+import threading
+import time
+
+from iec62056 import IEC_62056_STARTCHARACTER, IEC_62056_TRANSMISSIONREQUESTCOMMAND, IEC_62056_ACK, IEC_62056_NACK, IEC_62056_SOH, \
+                     IEC_62056_REGISTER_MAP, iec_62056_generate_programming_command_message, iec_62056_check_bcc, \
+                     iec_62056_interpret_data_message, iec_62056_generate_data_message, iec_62056_request_length, \
+                     iec_62056_character_time, iec62056_socket_transport, iec62056_loopback_transport
+
+
+DRS110M_SIMULATOR_VALUES = {'Voltage':'02301',
+                            'Current':'00012',
+                            'Frequency':'00500',
+                            'Active Power':'00027',
+                            'Reactive Power':'00001',
+                            'Apparent Power':'00028',
+                            'Active Energy':'00012345',
+                            'Time':'26101901123000',
+                            'Temperature':'0016',
+                            'Serial Port':'000001',
+                            'Baudrate':'4',
+                            'Meter ID':'001613300153',
+                            }
+
+
+class drs110m_simulator():
+    """ simulated DRS110M on a multi drop bus, answers only after it was addressed """
+    def __init__(self,device_address,values=None,password=0,reg_map=IEC_62056_REGISTER_MAP):
+        """
+        @param device_address: the meter address as int
+        @param values: dictionary of register name to value string, DRS110M_SIMULATOR_VALUES if not given
+        """
+        self.device_address = device_address
+        self.password = password
+        self.reg_map = reg_map
+        if values is None:
+            values = DRS110M_SIMULATOR_VALUES
+        self.values = dict((reg_map[name].address,val) for name,val in values.items())
+        self.values.update({reg_map['Meter ID'].address:'{0:012}'.format(device_address)})
+        self.selected = False
+        self.programming = False
+
+    def identification(self):
+        return '/BGE:{0:012}\r\n'.format(self.device_address).encode()
+
+    def respond(self,request):
+        """
+        @param request: one complete request
+        @return: the reply or None if the meter keeps silent
+        """
+        if request[:2] == IEC_62056_STARTCHARACTER+IEC_62056_TRANSMISSIONREQUESTCOMMAND:
+            addr = request[2:-3]
+            self.selected = not addr or int(addr) == self.device_address
+            self.programming = False
+            return self.identification() if self.selected else None
+        if not self.selected:
+            return None
+        if request[:1] == IEC_62056_ACK:
+            return iec_62056_generate_programming_command_message(cmd='P',cmd_type=0,data='({0:08})'.format(0))
+        if request[:1] != IEC_62056_SOH:
+            return None
+        if not iec_62056_check_bcc(request):
+            return IEC_62056_NACK
+        cmd = request[1:3]
+        if cmd == b'B0':
+            self.selected = False
+            self.programming = False
+            return None
+        if cmd == b'P1':
+            self.programming = int(request[5:-3]) == self.password
+            return IEC_62056_ACK if self.programming else IEC_62056_NACK
+        if not self.programming:
+            return IEC_62056_NACK
+        key,val = iec_62056_interpret_data_message(request[3:])
+        addr = int(key,16)
+        if cmd == b'R1':
+            if addr not in self.values:
+                return IEC_62056_NACK
+            return iec_62056_generate_data_message('{0:08x}({1})'.format(addr,self.values[addr]))
+        if cmd == b'W1':
+            self.values[addr] = val
+            return IEC_62056_ACK
+        return IEC_62056_NACK
+
+
+class iec62056_virtual_bus():
+    """ multi drop bus of simulated meters, every request is offered to all of them """
+    def __init__(self,responders,turnaround=0,baudrate=None):
+        """
+        @param turnaround: reaction time of the meters in seconds or a tuple (min,max) to draw it from
+        @param baudrate: adds the time on the wire of request and reply to the turnaround if given
+        """
+        self.responders = list(responders)
+        self.lock = threading.Lock()
+        self.turnaround = turnaround
+        self.char_time = iec_62056_character_time(baudrate) if baudrate else 0
+        self.requests = 0
+
+    def get_reply_delay(self,request,reply):
+        if isinstance(self.turnaround,(tuple,list)):
+            turnaround = random.uniform(*self.turnaround)
+        else:
+            turnaround = self.turnaround
+        return turnaround+(len(request)+len(reply))*self.char_time
+
+    def handle(self,request):
+        with self.lock:
+            self.requests += 1
+            replies = [r.respond(request) for r in self.responders]
+        return b''.join([r for r in replies if r])
+
+    def serve(self,transport):
+        """ answer requests on transport until it is closed """
+        rxbuff = bytearray()
+        while transport.isOpen():
+            data = transport.read(4096)
+            if not data:
+                continue
+            rxbuff.extend(data)
+            while rxbuff:
+                length = iec_62056_request_length(rxbuff)
+                if not length:
+                    break
+                request = bytes(rxbuff[:length])
+                reply = self.handle(request)
+                del rxbuff[:length]
+                if reply and transport.isOpen():
+                    delay = self.get_reply_delay(request,reply)
+                    if delay > 0:
+                        time.sleep(delay)
+                    transport.write(reply)
+        return
+
+    def connect(self,portsettings=None):
+        """ @return: a loopback transport to pass as port to iec62056, the bus side is served by a thread """
+        ours,theirs = iec62056_loopback_transport.pair(portsettings=portsettings)
+        theirs.timeout = 0.5
+        t = threading.Thread(target=self.serve,args=(theirs,))
+        t.daemon = True
+        t.start()
+        return ours
+
+
+class iec62056_tcp_standin_server():
+    """ local tcp serial server stand-in, every connection talks to the same virtual bus """
+    def __init__(self,bus,host='127.0.0.1',port=0):
+        self.bus = bus
+        self.listener = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.listener.bind((host,port))
+        self.listener.listen(8)
+        self.host,self.port = self.listener.getsockname()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.is_open = True
+        self.acceptor = threading.Thread(target=self.handleaccept)
+        self.acceptor.daemon = True
+        self.acceptor.start()
+
+    @property
+    def url(self):
+        return 'tcp://{0}:{1}'.format(self.host,self.port)
+
+    def handleaccept(self):
+        while self.is_open:
+            try:
+                sock,_ = self.listener.accept()
+            except OSError:
+                break
+            if not self.is_open:#closed while waiting in accept()
+                sock.close()
+                break
+            self.accepted += 1
+            transport = iec62056_socket_transport(sock=sock,portsettings={'timeout':0.5})
+            with self.lock:
+                self.connections.append(transport)
+            t = threading.Thread(target=self.bus.serve,args=(transport,))
+            t.daemon = True
+            t.start()
+        return
+
+    def drop_connections(self):
+        """ close all client connections like a gateway reboot would """
+        with self.lock:
+            connections,self.connections = self.connections,[]
+        for transport in connections:
+            transport.close()
+        return
+
+    def close(self):
+        """ stop accepting and drop all connections like a gateway going down """
+        self.is_open = False
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)#wakes the acceptor from accept()
+        except OSError:
+            pass
+        self.listener.close()
+        self.acceptor.join(1)
+        self.drop_connections()
+        return
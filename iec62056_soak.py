@@ -0,0 +1,292 @@
+# iec62056_soak.py
+# Load and soak test of the iec62056 + drs110m polling against virtual buses of simulated DRS110M meters.
+# Records throughput, latency percentiles, memory and thread counts over time to catch leaks and regressions.
+import gc
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+from iec62056 import iec62056, drs110m, iec62056_histogram, app_log
+from iec62056_simulator import drs110m_simulator, iec62056_virtual_bus
+
+
+IEC_62056_SOAK_FIRST_ADDRESS = 1613300000
+IEC_62056_SOAK_LATENCY_BUCKETS = tuple([0.001*1.1**k for k in range(100)])#10% resolution up to 12s
+
+
+def get_rss():
+    """ @return: resident set size of this process in bytes """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError,IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024#peak only
+
+
+def get_slope(xs,ys):
+    """ least squares slope of ys over xs """
+    n = len(xs)
+    if n < 2:
+        return 0.0
+    mx = sum(xs)/n
+    my = sum(ys)/n
+    sxx = sum([(x-mx)**2 for x in xs])
+    if not sxx:
+        return 0.0
+    return sum([(x-mx)*(y-my) for x,y in zip(xs,ys)])/sxx
+
+
+class iec62056_soak_test():
+    """ polls hundreds of simulated meters on one or more virtual buses, one iec62056 and one thread per bus
+        a sample is taken every sample_interval seconds
+    """
+    def __init__(self,meters=200,buses=1,duration=3600,sample_interval=60,turnaround=(0.02,0.05),baudrate=9600,
+                 regs=None,trace_memory=False,output=None,on_sample=None,join_timeout=10):
+        """
+        @param meters: number of simulated meters, spread evenly over the buses
+        @param duration: seconds to run
+        @param turnaround: reaction time of the simulated meters, see iec62056_virtual_bus
+        @param baudrate: the simulated wire speed
+        @param regs: registers to read per session, all if not given
+        @param trace_memory: record python heap usage with tracemalloc and report the largest growth
+        @param output: file to append every sample to as json line
+        @param on_sample: callback on_sample(sample)
+        @param join_timeout: seconds to wait for each worker to finish its session on stop
+        """
+        self.meters = meters
+        self.bus_count = buses
+        self.duration = duration
+        self.sample_interval = sample_interval
+        self.turnaround = turnaround
+        self.baudrate = baudrate
+        self.regs = regs
+        self.trace_memory = trace_memory
+        self.output = output
+        self.on_sample = on_sample
+        self.join_timeout = join_timeout
+        self.buses = []
+        self.devs = []
+        self.meter_objs = []#list of drs110m per bus
+        self.workers = []
+        self.cycles = []#completed polling cycles per bus
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.samples = []
+        self.reset_window()
+        self.snapshot = None
+
+    def reset_window(self):
+        self.window_sessions = 0
+        self.window_failures = 0
+        self.window_errors = 0
+        self.window_reads = 0
+        self.window_latency = iec62056_histogram(bounds=IEC_62056_SOAK_LATENCY_BUCKETS)
+        return
+
+    def setup(self):
+        addresses = list(range(IEC_62056_SOAK_FIRST_ADDRESS,IEC_62056_SOAK_FIRST_ADDRESS+self.meters))
+        for idx in range(self.bus_count):
+            bus_addresses = addresses[idx::self.bus_count]
+            bus = iec62056_virtual_bus([drs110m_simulator(a) for a in bus_addresses],turnaround=self.turnaround,baudrate=self.baudrate)
+            dev = iec62056(port=bus.connect())
+            self.buses.append(bus)
+            self.devs.append(dev)
+            self.meter_objs.append([drs110m(iec62056_dev=dev,device_address=a,regs=self.regs) for a in bus_addresses])
+            self.cycles.append(0)
+        return
+
+    def poll_bus(self,idx):
+        while not self.stop_event.is_set():
+            for meter in self.meter_objs[idx]:
+                if self.stop_event.is_set():
+                    break
+                t0 = time.perf_counter()
+                try:
+                    ok = meter.update_values()
+                except Exception:#keep polling, a dead worker would look like a throughput drop only
+                    app_log.exception('soak test session with {0} raised'.format(meter.device_address))
+                    ok = None
+                dur = time.perf_counter()-t0
+                with self.lock:
+                    self.window_sessions += 1
+                    if ok is None:
+                        self.window_errors += 1
+                    elif ok:
+                        self.window_reads += len(meter.reg_dict.registers)
+                        self.window_latency.add(dur)
+                    else:
+                        self.window_failures += 1
+            else:
+                self.cycles[idx] += 1
+        return
+
+    def get_queue_sizes(self):
+        sizes = dict.fromkeys(('data_queue','programm_queue','acknowledge_queue','identification_queue','txqueue'),0)
+        for dev in self.devs:
+            for name in sizes:
+                sizes[name] += getattr(dev,name).qsize()
+        return sizes
+
+    def sample(self,elapsed,interval):
+        with self.lock:
+            sessions,failures,errors,reads,latency = self.window_sessions,self.window_failures,self.window_errors,self.window_reads,self.window_latency
+            self.reset_window()
+        sample = {'elapsed':elapsed,
+                  'cycles':min(self.cycles),
+                  'sessions':sessions,
+                  'failures':failures,
+                  'errors':errors,
+                  'sessions_per_s':sessions/interval if interval else 0,
+                  'reads_per_s':reads/interval if interval else 0,
+                  'latency_p50':latency.percentile(50),
+                  'latency_p90':latency.percentile(90),
+                  'latency_p99':latency.percentile(99),
+                  'latency_max':latency.max,
+                  'rss':get_rss(),
+                  'threads':threading.active_count(),
+                  'gc_objects':len(gc.get_objects()),
+                  'stats_entries':sum([len(dev.stats) for dev in self.devs]),
+                  'meter_objs':sum([len(dev.meter_objs) for dev in self.devs]),
+                  'bus_requests':sum([bus.requests for bus in self.buses]),
+                  }
+        sample.update(self.get_queue_sizes())
+        if self.trace_memory:
+            sample.update({'traced':tracemalloc.get_traced_memory()[0]})
+        self.samples.append(sample)
+        app_log.info('soak sample {0}'.format(sample))
+        if self.output:
+            with open(self.output,'a') as f:
+                f.write('{0}\n'.format(json.dumps(sample)))
+        if self.on_sample:
+            self.on_sample(sample)
+        return sample
+
+    def run(self):
+        """ @return: the report, see get_report() """
+        if self.trace_memory:
+            tracemalloc.start()
+        self.setup()
+        for idx in range(self.bus_count):
+            t = threading.Thread(target=self.poll_bus,args=(idx,))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        t0 = time.monotonic()
+        last = t0
+        k = 1
+        try:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                if now-t0 >= self.duration:
+                    break
+                wait = min(t0+k*self.sample_interval,t0+self.duration)-now
+                if wait > 0 and self.stop_event.wait(wait):
+                    break
+                now = time.monotonic()
+                sample = self.sample(elapsed=now-t0,interval=now-last)
+                if self.snapshot is None and self.trace_memory and sample['cycles']:
+                    self.snapshot = tracemalloc.take_snapshot()#every meter was polled once
+                last = now
+                k += 1
+        finally:
+            self.stop()
+        return self.get_report()
+
+    def stop(self):
+        self.stop_event.set()
+        for idx,t in enumerate(self.workers):
+            t.join(timeout=self.join_timeout)
+            if t.is_alive():#a hung worker is a finding, not a reason to block for hours
+                app_log.error('soak test worker of bus {0} did not stop within {1}s'.format(idx,self.join_timeout))
+        for dev in self.devs:
+            dev.close()
+        return
+
+    def get_report(self,warmup=None,min_span=600,min_samples=3,rss_limit=10*2**20,rss_min_growth=4*2**20,throughput_drop=0.2):
+        """ evaluate the samples after the warm up
+            trends are only judged over at least min_span seconds and min_samples samples,
+            a short run extrapolates noise to large per hour rates
+            @param warmup: number of samples to skip, by default all samples until every meter was polled once
+                           as the first cycle allocates the per meter state
+            @param rss_limit: tolerated rss growth in bytes per hour
+            @param rss_min_growth: rss growth in bytes over the evaluated span below which the rate is not reported
+            @param throughput_drop: tolerated relative drop of the throughput from the first to the last sample
+            @return: dictionary with trends per hour, totals and a list of suspects
+        """
+        if warmup is None:
+            samples = [s for s in self.samples if s['cycles']]
+        else:
+            samples = self.samples[warmup:]
+        span = samples[-1]['elapsed']-samples[0]['elapsed'] if samples else 0
+        report = {'samples':len(self.samples),
+                  'evaluated':len(samples),
+                  'span':span,
+                  'sessions':sum([s['sessions'] for s in self.samples]),
+                  'failures':sum([s['failures'] for s in self.samples]),
+                  'errors':sum([s['errors'] for s in self.samples]),
+                  'trends':{},
+                  'suspects':[],
+                  }
+        if report['errors']:
+            report['suspects'].append('{0} sessions raised an exception'.format(report['errors']))
+        if self.snapshot is not None:
+            top = tracemalloc.take_snapshot().compare_to(self.snapshot,'lineno')[:10]
+            report.update({'memory_growth':[str(stat) for stat in top]})
+            self.snapshot = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if len(samples) < 2:
+            app_log.error('soak test too short, {0} samples after the warm up'.format(len(samples)))
+            return report
+        xs = [s['elapsed']/3600 for s in samples]
+        for key in ('rss','threads','gc_objects','stats_entries','meter_objs','data_queue','programm_queue',
+                    'acknowledge_queue','identification_queue','txqueue','traced','sessions_per_s','latency_p99'):
+            if key in samples[0] and all([s[key] is not None for s in samples]):
+                report['trends'].update({key:{'first':samples[0][key],
+                                              'last':samples[-1][key],
+                                              'per_hour':get_slope(xs,[s[key] for s in samples])}})
+        trends = report['trends']
+        if len(samples) < min_samples or span < min_span:
+            app_log.error('soak test too short to judge trends, {0} samples over {1:.0f}s after the warm up'.format(len(samples),span))
+            return report
+        if trends['rss']['per_hour'] > rss_limit and trends['rss']['last']-trends['rss']['first'] > rss_min_growth:
+            report['suspects'].append('rss grows {0:.1f} MiB per hour'.format(trends['rss']['per_hour']/2**20))
+        for key in ('threads','stats_entries','meter_objs','data_queue','programm_queue','acknowledge_queue','identification_queue','txqueue'):
+            if trends[key]['last'] > trends[key]['first'] and trends[key]['per_hour'] > 0:
+                report['suspects'].append('{0} grows from {1} to {2}'.format(key,trends[key]['first'],trends[key]['last']))
+        first,last = trends['sessions_per_s']['first'],trends['sessions_per_s']['last']
+        if first and last < first*(1-throughput_drop):
+            report['suspects'].append('throughput drops from {0:.2f} to {1:.2f} sessions/s'.format(first,last))
+        return report
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    from pprint import pprint
+    parser = OptionParser()
+    parser.add_option("-m", "--meters", dest="meters", type="int", default=200,
+                      help="number of simulated METERS", metavar="METERS")
+    parser.add_option("-b", "--buses", dest="buses", type="int", default=1,
+                      help="number of virtual BUSES, each polled by its own iec62056", metavar="BUSES")
+    parser.add_option("-d", "--duration", dest="duration", type="float", default=3600,
+                      help="DURATION of the run in seconds", metavar="DURATION")
+    parser.add_option("-i", "--interval", dest="interval", type="float", default=60,
+                      help="sample INTERVAL in seconds", metavar="INTERVAL")
+    parser.add_option("-t", "--turnaround", dest="turnaround", default="0.02,0.05",
+                      help="meter TURNAROUND in seconds, min,max", metavar="TURNAROUND")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="OUTPUT file for the samples as json lines", metavar="OUTPUT")
+    parser.add_option("--trace-memory", dest="trace_memory", action="store_true", default=False,
+                      help="trace the python heap and report the largest growth")
+
+    (options, args) = parser.parse_args()
+
+    turnaround = tuple([float(x) for x in options.turnaround.split(',')])
+    soak = iec62056_soak_test(meters=options.meters,buses=options.buses,duration=options.duration,sample_interval=options.interval,
+                              turnaround=turnaround if len(turnaround) > 1 else turnaround[0],
+                              trace_memory=options.trace_memory,output=options.output,
+                              on_sample=lambda s:print(json.dumps(s)))
+    pprint(soak.run())
@@ -0,0 +1,568 @@
+# sml.py
+# Smart Message Language (SML) push mode decoder for eHZ meters
+# eHZ meters push SML telegrams continuously on the optical interface, 9600 baud 8N1
+import serial
+import threading
+import select
+import os
+import time
+import random
+import logging
+from datetime import datetime
+from pprint import pprint
+
+from iec62056 import iec62056_register, iec62056_reading
+
+
+app_log = logging.getLogger('iec62056.sml')
+
+
+SML_ESCAPE = b'\x1b\x1b\x1b\x1b'
+SML_START = b'\x01\x01\x01\x01'
+SML_END_MARKER = 0x1a
+SML_MAX_TELEGRAM_LENGTH = 16384#resync if no end sequence shows up within this
+
+SML_TYPE_OCTET_STRING = 0x0
+SML_TYPE_BOOLEAN = 0x4
+SML_TYPE_INTEGER = 0x5
+SML_TYPE_UNSIGNED = 0x6
+SML_TYPE_LIST = 0x7
+
+SML_MESSAGE_OPEN_RESPONSE = 0x0101
+SML_MESSAGE_CLOSE_RESPONSE = 0x0201
+SML_MESSAGE_GET_LIST_RESPONSE = 0x0701
+
+#DLMS unit codes as used by SML
+SML_UNITS = {7:'s',
+             9:'°C',
+             27:'W',
+             28:'VA',
+             29:'var',
+             30:'Wh',
+             31:'VAh',
+             32:'varh',
+             33:'A',
+             35:'V',
+             44:'Hz',
+             255:'',
+             }
+
+SML_PORTSETTINGS = {'baudrate':9600,
+                    'bytesize':serial.EIGHTBITS,
+                    'parity':serial.PARITY_NONE,
+                    'stopbits':serial.STOPBITS_ONE,
+                    'timeout':0,
+                    }
+
+
+def _sml_crc16_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+SML_CRC16_TABLE = _sml_crc16_table()
+
+
+def sml_crc16_update(crc,data):
+    """ CRC16 X.25 without the final xor, to be continued chunk by chunk
+        @param crc: the running crc, 0xFFFF to start
+        @param data: the next bytes
+        @return: the running crc
+    """
+    table = SML_CRC16_TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+
+def sml_crc16(data):
+    return sml_crc16_update(0xFFFF,data) ^ 0xFFFF
+
+
+def sml_obis_from_bytes(obj_name):
+    """ @return: the OBIS code as string A-B:C.D.E*F """
+    if len(obj_name) != 6:
+        return obj_name.hex()
+    return '{0}-{1}:{2}.{3}.{4}*{5}'.format(*obj_name)
+
+
+def sml_parse_tlv(buf,pos=0):
+    """ parse one SML TLV element
+        @param buf: the message bytes
+        @param pos: the position of the type length field
+        @return: tuple of value and the position after the element,
+                 lists as python lists, optional values as None, octet strings as bytes
+    """
+    tl = buf[pos]
+    if tl == 0x00:#end of sml message
+        return None,pos+1
+    typ = (tl >> 4) & 0x7
+    length = tl & 0x0F
+    n = 1
+    while tl & 0x80:
+        tl = buf[pos+n]
+        length = (length << 4) | (tl & 0x0F)
+        n += 1
+    if typ == SML_TYPE_LIST:
+        pos += n
+        ret = []
+        for _ in range(length):
+            val,pos = sml_parse_tlv(buf,pos)
+            ret.append(val)
+        return ret,pos
+    if length < n or pos+length > len(buf):
+        raise ValueError('TLV length {0} at {1} out of range'.format(length,pos))
+    data = bytes(buf[pos+n:pos+length])
+    pos += length
+    if typ == SML_TYPE_OCTET_STRING:
+        if tl == 0x01 and not data:#optional value not set
+            return None,pos
+        return data,pos
+    elif typ == SML_TYPE_BOOLEAN:
+        return bool(data[0]),pos
+    elif typ == SML_TYPE_INTEGER:
+        return int.from_bytes(data,'big',signed=True),pos
+    elif typ == SML_TYPE_UNSIGNED:
+        return int.from_bytes(data,'big',signed=False),pos
+    raise ValueError('Unknown TLV type {0} at {1}'.format(typ,pos))
+
+
+class sml_decoder():
+    """ streaming SML transport decoder for one optical head
+        feed() takes arbitrary chunks, the crc is updated word by word as the data arrives
+        and only the current telegram is buffered
+    """
+    def __init__(self,on_telegram=None):
+        """
+        @param on_telegram: callback on_telegram(readings) for each telegram with a valid crc
+        """
+        self.on_telegram = on_telegram
+        self.registers = {}#(obis,unit) -> iec62056_register, shared by all telegrams
+        self.telegrams = 0
+        self.crc_errors = 0
+        self.parse_errors = 0
+        self.resyncs = 0
+        self.reset()
+
+    def reset(self):
+        self.in_telegram = False
+        self.hunt = bytearray()
+        self.word = bytearray()
+        self.body = bytearray()
+        self.escaped = False
+        self.crc = 0xFFFF
+        self.offset = 0#bytes of the telegram after the start sequence
+        self.recent = bytearray()#the last bytes of the telegram, to find a start sequence across chunks
+        return
+
+    def feed(self,data):
+        """
+        @param data: the next received bytes
+        @return: list of decoded telegrams, each a dictionary of OBIS code to iec62056_reading
+        """
+        ret = []
+        pos = 0
+        while pos < len(data):
+            if not self.in_telegram:
+                pos = self._hunt(data,pos)
+            else:
+                pos = self._feed_telegram(data,pos,ret)
+        return ret
+
+    def _feed_telegram(self,data,pos,telegrams):
+        """ word wise decoding inside a telegram
+            a start sequence off the word boundaries means a byte was lost on the line,
+            like libsml the telegram is dropped and decoding restarts after that start sequence
+            @param telegrams: list to append decoded telegrams to
+            @return: the position in data after the consumed bytes
+        """
+        first = pos
+        kept = len(self.recent)
+        window = bytes(self.recent)+bytes(data[pos:])
+        idx = window.find(SML_ESCAPE+SML_START)
+        while idx >= 0 and (self.offset+idx-kept) % 4 == 0:#on a word boundary, up to _on_word
+            idx = window.find(SML_ESCAPE+SML_START,idx+1)
+        end = len(data) if idx < 0 else max(first+idx-kept,first)
+        while pos < end and self.in_telegram:
+            piece = data[pos:min(pos+4-len(self.word),end)]
+            pos += len(piece)
+            self.offset += len(piece)
+            self.recent.extend(piece)
+            del self.recent[:-7]
+            self.word.extend(piece)
+            if len(self.word) == 4:
+                telegram = self._on_word(bytes(self.word))
+                self.word.clear()
+                if telegram is not None:
+                    telegrams.append(telegram)
+        if idx >= 0 and self.in_telegram:
+            app_log.error('Start sequence off the word boundaries, a byte was lost - restarting')
+            self.resyncs += 1
+            self._start()
+            pos = first+idx+8-kept
+        return pos
+
+    def _hunt(self,data,pos):
+        """ @return: the position in data after the start sequence, len(data) if not found """
+        kept = len(self.hunt)
+        self.hunt.extend(data[pos:])
+        idx = self.hunt.find(SML_ESCAPE+SML_START)
+        if idx < 0:
+            del self.hunt[:-7]#keep a possible partial start sequence
+            return len(data)
+        self.hunt.clear()
+        self._start()
+        return pos+idx+8-kept
+
+    def _start(self):
+        self.in_telegram = True
+        self.escaped = False
+        self.body = bytearray()
+        self.word.clear()
+        self.offset = 0
+        self.recent = bytearray()
+        self.crc = sml_crc16_update(0xFFFF,SML_ESCAPE+SML_START)
+        return
+
+    def _on_word(self,word):
+        if self.escaped:
+            self.escaped = False
+            if word == SML_ESCAPE:#escaped escape sequence is payload
+                self.crc = sml_crc16_update(self.crc,SML_ESCAPE+SML_ESCAPE)
+                self.body.extend(SML_ESCAPE)
+            elif word == SML_START:#restart
+                self.resyncs += 1
+                self._start()
+            elif word[0] == SML_END_MARKER:
+                return self._end(word)
+            else:
+                app_log.error('Unknown escape sequence {0}'.format(word.hex()))
+                self.resyncs += 1
+                self.reset()
+            return None
+        if word == SML_ESCAPE:
+            self.escaped = True
+            return None
+        self.crc = sml_crc16_update(self.crc,word)
+        self.body.extend(word)
+        if len(self.body) > SML_MAX_TELEGRAM_LENGTH:
+            app_log.error('Telegram exceeds {0} bytes without end sequence'.format(SML_MAX_TELEGRAM_LENGTH))
+            self.resyncs += 1
+            self.reset()
+        return None
+
+    def _end(self,word):
+        crc = sml_crc16_update(self.crc,SML_ESCAPE+word[:2]) ^ 0xFFFF
+        received = word[2] | (word[3] << 8)
+        fill = word[1]
+        body = self.body[:len(self.body)-fill] if fill else self.body
+        self.reset()
+        if crc != received:
+            app_log.error('CRC error calculated {0:04x} received {1:04x}'.format(crc,received))
+            self.crc_errors += 1
+            return None
+        try:
+            readings = self.parse_telegram(body)
+        except (ValueError,IndexError,TypeError) as e:
+            app_log.error('Parse error {0}'.format(e))
+            self.parse_errors += 1
+            return None
+        self.telegrams += 1
+        if self.on_telegram:
+            self.on_telegram(readings)
+        return readings
+
+    def get_register(self,obis,unit):
+        reg = self.registers.get((obis,unit))
+        if reg is None:
+            reg = iec62056_register(name=obis,address=None,length=0,unit=unit)
+            self.registers[(obis,unit)] = reg
+        return reg
+
+    def parse_telegram(self,body):
+        """ @return: dictionary of OBIS code to iec62056_reading of all GetList.Res entries """
+        now = datetime.now()
+        readings = {}
+        pos = 0
+        while pos < len(body):
+            msg,pos = sml_parse_tlv(body,pos)
+            if not isinstance(msg,list) or len(msg) < 4 or not isinstance(msg[3],list) or len(msg[3]) != 2:
+                continue
+            tag,content = msg[3]
+            if tag != SML_MESSAGE_GET_LIST_RESPONSE or not isinstance(content,list) or len(content) < 5:
+                continue
+            for entry in content[4] or []:
+                obj_name,status,val_time,unit,scaler,value = entry[:6]
+                obis = sml_obis_from_bytes(obj_name)
+                if isinstance(value,bytes):
+                    value = value.hex()
+                elif isinstance(value,int) and not isinstance(value,bool) and scaler:
+                    value = value*10**scaler
+                reg = self.get_register(obis,SML_UNITS.get(unit,'' if unit is None else str(unit)))
+                readings[obis] = iec62056_reading(register=reg,raw_data=entry,value=value,time_stamp=now)
+        return readings
+
+    def get_stats(self):
+        return {'telegrams':self.telegrams,
+                'crc_errors':self.crc_errors,
+                'parse_errors':self.parse_errors,
+                'resyncs':self.resyncs,
+                }
+
+
+def sml_obis_data(readings):
+    """ @return: the readings in the layout of iec_62056_interpret_obis_msg / pafal.obis_data, value*unit strings """
+    ret = {}
+    for obis,reading in readings.items():
+        if reading.unit:
+            ret[obis] = '{0}*{1}'.format(reading.value,reading.unit)
+        else:
+            ret[obis] = '{0}'.format(reading.value)
+    return ret
+
+
+def sml_encode_tl(typ,length):
+    """ encode a type length field, for non lists length is the payload length """
+    if typ != SML_TYPE_LIST:
+        total = length+1
+        if total > 15:
+            total = length+2
+        length = total
+    if length <= 15:
+        return bytes([(typ << 4) | length])
+    return bytes([0x80 | (typ << 4) | ((length >> 4) & 0x0F),length & 0x0F])
+
+
+def sml_encode_octet_string(data):
+    if data is None:
+        return b'\x01'
+    return sml_encode_tl(SML_TYPE_OCTET_STRING,len(data))+bytes(data)
+
+
+def sml_encode_unsigned(val,size=4):
+    return sml_encode_tl(SML_TYPE_UNSIGNED,size)+val.to_bytes(size,'big')
+
+
+def sml_encode_integer(val,size=4):
+    return sml_encode_tl(SML_TYPE_INTEGER,size)+val.to_bytes(size,'big',signed=True)
+
+
+def sml_encode_list(elements):
+    return sml_encode_tl(SML_TYPE_LIST,len(elements))+b''.join(elements)
+
+
+def sml_encode_message(transaction_id,tag,content):
+    """ @return: a SML_Message with its own crc and end of message """
+    msg = bytearray(b'\x76')#list of 6
+    msg.extend(sml_encode_octet_string(transaction_id))
+    msg.extend(sml_encode_unsigned(0,1))#group no
+    msg.extend(sml_encode_unsigned(0,1))#abort on error
+    msg.extend(sml_encode_list([sml_encode_unsigned(tag,2),content]))
+    crc = sml_crc16(msg)
+    msg.extend(sml_encode_unsigned(crc,2))
+    msg.append(0x00)
+    return bytes(msg)
+
+
+def sml_encode_get_list_response(server_id,values,transaction_id=b'\x01'):
+    """
+    @param server_id: the meter id as bytes
+    @param values: list of tuples (obis as 6 ints, unit code, scaler, value)
+    @return: a GetList.Res SML_Message
+    """
+    entries = []
+    for obis,unit,scaler,value in values:
+        if isinstance(value,bytes):
+            enc_val = sml_encode_octet_string(value)
+        elif value < 0:
+            enc_val = sml_encode_integer(value,8)
+        else:
+            enc_val = sml_encode_unsigned(value,8)
+        entries.append(sml_encode_list([sml_encode_octet_string(bytes(obis)),
+                                        b'\x01',#status
+                                        b'\x01',#val time
+                                        sml_encode_unsigned(unit,1) if unit is not None else b'\x01',
+                                        sml_encode_integer(scaler,1) if scaler is not None else b'\x01',
+                                        enc_val,
+                                        b'\x01',#signature
+                                        ]))
+    content = sml_encode_list([b'\x01',#client id
+                               sml_encode_octet_string(server_id),
+                               b'\x01',#list name
+                               b'\x01',#act sensor time
+                               sml_encode_list(entries),
+                               b'\x01',#list signature
+                               b'\x01',#act gateway time
+                               ])
+    return sml_encode_message(transaction_id,SML_MESSAGE_GET_LIST_RESPONSE,content)
+
+
+def sml_encode_transport(messages):
+    """ @return: a complete telegram with start and end sequences, escaping, fill bytes and crc """
+    payload = bytearray(b''.join(messages))
+    fill = (-len(payload)) % 4
+    payload.extend(b'\x00'*fill)
+    out = bytearray(SML_ESCAPE+SML_START)
+    for idx in range(0,len(payload),4):
+        word = payload[idx:idx+4]
+        if word == SML_ESCAPE:
+            out.extend(SML_ESCAPE)
+        out.extend(word)
+    out.extend(SML_ESCAPE)
+    out.append(SML_END_MARKER)
+    out.append(fill)
+    crc = sml_crc16(out)
+    out.append(crc & 0xFF)
+    out.append(crc >> 8)
+    return bytes(out)
+
+
+class sml_standin_stream():
+    """ byte stream stand-in for an optical head
+        pushes the telegrams in random chunk sizes into a pipe, has fileno() and read() like a serial port
+    """
+    def __init__(self,telegrams,interval=0.01,max_chunk=64,repeat=True):
+        """
+        @param telegrams: list of complete telegrams as bytes
+        @param interval: pause between telegrams in seconds
+        @param max_chunk: upper limit of the random chunk size
+        @param repeat: start again after the last telegram
+        """
+        self.telegrams = telegrams
+        self.interval = interval
+        self.max_chunk = max_chunk
+        self.repeat = repeat
+        self.rfd,self.wfd = os.pipe()
+        self.is_open = True
+        self.writer = threading.Thread(target=self.handlewrite)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def handlewrite(self):
+        while self.is_open:
+            for telegram in self.telegrams:
+                pos = 0
+                while pos < len(telegram) and self.is_open:
+                    n = random.randint(1,self.max_chunk)
+                    try:
+                        os.write(self.wfd,telegram[pos:pos+n])
+                    except OSError:
+                        return
+                    pos += n
+                time.sleep(self.interval)
+            if not self.repeat:
+                break
+        return
+
+    def fileno(self):
+        return self.rfd
+
+    def read(self,n=4096):
+        return os.read(self.rfd,n)
+
+    def isOpen(self):
+        return self.is_open
+
+    def close(self):
+        self.is_open = False
+        os.close(self.wfd)
+        self.writer.join()
+        os.close(self.rfd)
+        return
+
+
+class sml_gateway():
+    """ reads many optical heads in one thread, select() on all ports and feed the decoders """
+    def __init__(self):
+        self.heads = {}#fileno -> (name,stream,decoder)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def add_head(self,name,stream,on_telegram=None):
+        """
+        @param name: name of the head, passed to on_telegram
+        @param stream: an opened port, anything with fileno() and a non blocking read()
+        @param on_telegram: callback on_telegram(name,readings)
+        @return: the sml_decoder of the head
+        """
+        cb = (lambda readings:on_telegram(name,readings)) if on_telegram else None
+        decoder = sml_decoder(on_telegram=cb)
+        with self.lock:
+            self.heads[stream.fileno()] = (name,stream,decoder)
+        return decoder
+
+    def remove_head(self,fd):
+        """ stop reading the head and close its port """
+        with self.lock:
+            name,stream,decoder = self.heads.pop(fd)
+        try:
+            stream.close()
+        except (OSError,serial.SerialException):
+            pass
+        return
+
+    def open_head(self,port,on_telegram=None,portsettings=SML_PORTSETTINGS):
+        try:
+            ser = serial.Serial(port=port,**portsettings)
+        except serial.SerialException:
+            app_log.error('SerialException - Could not open Serial Port {0}'.format(port))
+            raise ValueError('Could not open Serial Port {0}'.format(port))
+        return self.add_head(name=port,stream=ser,on_telegram=on_telegram)
+
+    def poll(self,timeout=1):
+        """ wait up to timeout for data on any head and decode it """
+        with self.lock:
+            heads = dict(self.heads)
+        if not heads:
+            time.sleep(timeout)
+            return
+        try:
+            readable,_,_ = select.select(list(heads),[],[],timeout)
+        except (OSError,ValueError):#a port closed under us, find it below
+            readable = list(heads)
+        for fd in readable:
+            name,stream,decoder = heads[fd]
+            try:
+                data = stream.read(4096)
+            except (OSError,ValueError,serial.SerialException) as e:#e.g. unplugged usb adapter, the other heads go on
+                app_log.error('Could not read optical head {0} - removing it: {1}'.format(name,e))
+                self.remove_head(fd)
+                continue
+            if data:
+                decoder.feed(data)
+        return
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.poll(timeout=0.5)
+        return
+
+    def stop(self):
+        self.stop_event.set()
+        return
+
+    def get_stats(self):
+        with self.lock:
+            heads = list(self.heads.values())
+        return dict((name,decoder.get_stats()) for name,stream,decoder in heads)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("-p", "--port", dest="ports", action="append", default=None,
+                      help="PORT of an optical head, can be given multiple times", metavar="PORT")
+
+    (options, args) = parser.parse_args()
+
+    gw = sml_gateway()
+    for port in options.ports or ['/dev/ttyUSB0']:
+        gw.open_head(port,on_telegram=lambda name,readings:pprint({name:sml_obis_data(readings)}))
+    try:
+        gw.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,159 @@
+# test_iec62056.py
+# iec62056 + drs110m against simulated meters over the loopback and the pooled raw tcp transport, bus discovery
+import socket
+import threading
+import time
+
+import pytest
+
+from iec62056 import iec62056, drs110m, drs110m_bus_discovery, iec62056_mode_d_listener, iec_62056_interpret_identification_message, iec_62056_parse_address_spec, iec62056_retry_policy, IEC_62056_TCP_POOL, \
+                     iec62056_loopback_transport
+from iec62056_simulator import drs110m_simulator, iec62056_virtual_bus, iec62056_tcp_standin_server
+
+
+METER = 1613300153
+
+
+def make_dev(port):
+    dev = iec62056(port=port,portsettings={'baudrate':9600,'timeout':0.1})
+    dev.timeout = 0.3
+    dev.retry_policy = iec62056_retry_policy(max_attempts=1)
+    return dev
+
+
+@pytest.fixture
+def bus():
+    return iec62056_virtual_bus([drs110m_simulator(METER)])
+
+
+@pytest.fixture
+def server(bus):
+    srv = iec62056_tcp_standin_server(bus)
+    yield srv
+    srv.close()
+    IEC_62056_TCP_POOL.close_all()
+
+
+def test_loopback(bus):
+    dev = make_dev(bus.connect())
+    meter = drs110m(iec62056_dev=dev,device_address=METER,regs=['Voltage','Meter ID'])
+    try:
+        assert meter.update_values()
+        assert meter.reg_values['Voltage'].value == 230.1
+        assert meter.reg_values['Meter ID'].value == METER
+    finally:
+        dev.close()
+
+
+def test_flush_while_reading():
+    ours,theirs = iec62056_loopback_transport.pair(portsettings={'timeout':0.1})
+    stop = threading.Event()
+
+    def rx():
+        while not stop.is_set():
+            ours.read(4096)
+
+    t = threading.Thread(target=rx)
+    t.start()
+    try:
+        t0 = time.monotonic()
+        for _ in range(2000):
+            theirs.write(b'/?1613300153!\r\n')
+            ours.flushInput()
+        assert time.monotonic()-t0 < 5
+        t0 = time.monotonic()
+        assert ours.read(1) == b''
+        assert time.monotonic()-t0 < 1
+    finally:
+        stop.set()
+        t.join(1)
+        ours.close()
+        theirs.close()
+    assert not t.is_alive()
+
+
+@pytest.mark.parametrize('msg',[b'/ABCH12\r\n',b'/\r\n',b'/A\xffC5XYZ\r\n',b'/1235XYZ\r\n'])
+def test_interpret_malformed_identification(msg):
+    with pytest.raises(ValueError):
+        iec_62056_interpret_identification_message(msg)
+
+
+def test_listener_survives_malformed_frames():
+    ours,theirs = iec62056_loopback_transport.pair()
+    dev = iec62056(port=ours)
+    listener = iec62056_mode_d_listener(iec62056_dev=dev)
+    try:
+        for garbage in (b'/ABCH12\r\n',b'/\r\n',b'/A\xffC5XYZ\r\n'):
+            theirs.write(garbage)
+            time.sleep(0.1)
+        theirs.write(b'/ISK5MT174-0001\r\n\r\n1.8.0(0001234.5*kWh)\r\n!\r\n')
+        telegram = listener.get_telegram(timeout=2)
+        assert telegram['identification'] == 'MT174-0001'
+        assert telegram['obis_data'] == {'1.8.0':'0001234.5*kWh'}
+        assert dev.rxhandler.is_alive()
+        assert dev.meter_stats().counters['malformed_frames'] == 3
+    finally:
+        dev.close()
+        theirs.close()
+
+
+def test_tcp_pooled_connection(server):
+    for _ in range(3):
+        dev = make_dev(server.url)
+        meter = drs110m(iec62056_dev=dev,device_address=METER,regs=['Voltage'])
+        assert meter.update_values()
+        dev.close()
+    assert server.accepted == 1
+    assert len(IEC_62056_TCP_POOL.connections) == 1
+
+
+def test_tcp_reconnect(server):
+    dev = make_dev(server.url)
+    meter = drs110m(iec62056_dev=dev,device_address=METER,regs=['Voltage'])
+    try:
+        assert meter.update_values()
+        server.drop_connections()
+        time.sleep(0.2)
+        assert meter.update_values()
+        assert dev.ser.reconnects == 1
+        assert server.accepted == 2
+    finally:
+        dev.close()
+
+
+def test_tcp_outage(bus,server):
+    dev = make_dev(server.url)
+    meter = drs110m(iec62056_dev=dev,device_address=METER,regs=['Voltage'])
+    try:
+        assert meter.update_values()
+        port = server.port
+        server.close()
+        with pytest.raises(ConnectionRefusedError):
+            socket.create_connection(('127.0.0.1',port),timeout=1)
+        assert server.accepted == 1
+        for _ in range(dev.breaker_settings['failure_threshold']):
+            assert not meter.update_values()
+        assert dev.circuit_breaker(METER).state == 'open'
+        assert dev.txhandler.is_alive() and dev.rxhandler.is_alive()
+
+        restarted = iec62056_tcp_standin_server(bus,port=port)
+        try:
+            dev.breakers.clear()
+            time.sleep(dev.ser.reconnect_delay)
+            assert meter.update_values()
+        finally:
+            restarted.close()
+    finally:
+        dev.close()
+
+
+def test_discovery_slow_meters():
+    addresses = (1613300151,1613300153)
+    bus = iec62056_virtual_bus([drs110m_simulator(a) for a in addresses],turnaround=0.2,baudrate=9600)
+    dev = make_dev(bus.connect())
+    try:
+        discovery = drs110m_bus_discovery(iec62056_dev=dev)
+        found = discovery.discover(iec_62056_parse_address_spec('1613300150-1613300155'))
+        assert sorted([m['address'] for m in found]) == list(addresses)
+    finally:
+        dev.close()
@@ -0,0 +1,78 @@
+# test_iec62056_bulk.py
+# the bulk decoder against the scalar decoding of the same R1 reply frames
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from iec62056 import IEC_62056_REGISTER_MAP, iec_62056_generate_data_message
+from iec62056_bulk import iec_62056_bulk_decode_r1
+from iec62056_simulator import DRS110M_SIMULATOR_VALUES
+
+
+MALFORMED = [('Active Energy','00-12345'),
+             ('Voltage','23A1'),
+             ('Voltage',''),
+             ('Meter ID','0016133 0153'),
+             ('Time','26133203996116'),#month 13
+             ('Time','26023001120000'),#february 30
+             ('Time','26101901243000'),#hour 24
+             ('Time','2610190112300'),
+             ('Temperature','00G6'),
+             ('Baudrate','9'),
+             ]
+
+
+def make_frame(name,value):
+    return iec_62056_generate_data_message('{0:08x}({1})'.format(IEC_62056_REGISTER_MAP[name].address,value))
+
+
+def scalar_decode(frame):
+    """ @return: the value decoded by IEC_62056_REGISTER_MAP.decode or None if it fails """
+    try:
+        reg,value = IEC_62056_REGISTER_MAP.decode(frame)
+    except ValueError:
+        return None
+    return value
+
+
+def make_frames():
+    frames = [make_frame(name,value) for name,value in DRS110M_SIMULATOR_VALUES.items()]
+    frames.extend([make_frame('Temperature','00:?'),make_frame('Time','24022904235959')])
+    frames.extend([make_frame(name,value) for name,value in MALFORMED])
+    bad_bcc = bytearray(make_frame('Voltage','02301'))
+    bad_bcc[-1] ^= 0x01
+    frames.append(bytes(bad_bcc))
+    frames.append(iec_62056_generate_data_message('0000000g(02301)'))#no hex address
+    return frames
+
+
+def test_bulk_matches_scalar_decode():
+    """ a valid row has the value of the scalar decoding, rows the scalar decoding fails on are invalid
+        the bulk decoder is stricter on the length of the time field, strptime takes a single digit second
+    """
+    frames = make_frames()
+    cols = iec_62056_bulk_decode_r1(b'garbage'.join(frames))
+    assert len(cols['start']) == len(frames)
+    assert list(cols['bcc_valid']) == [True]*(len(frames)-2)+[False,True]
+    assert cols['valid'].sum() == len(DRS110M_SIMULATOR_VALUES)+2
+    for k,frame in enumerate(frames):
+        expected = scalar_decode(frame) if cols['bcc_valid'][k] else None
+        if not cols['valid'][k]:
+            continue
+        assert expected is not None,frame
+        if isinstance(expected,datetime):
+            assert cols['time'][k] == np.datetime64(expected,'s')
+        else:
+            assert cols['value'][k] == pytest.approx(expected)
+    for k,frame in enumerate(frames):
+        if scalar_decode(frame) is None:
+            assert not cols['valid'][k],frame
+
+
+@pytest.mark.parametrize('name,value',MALFORMED)
+def test_bulk_rejects_malformed_fields(name,value):
+    cols = iec_62056_bulk_decode_r1([make_frame(name,value)])
+    assert cols['bcc_valid'][0]
+    assert not cols['valid'][0]
+    assert np.isnan(cols['value'][0]) and np.isnat(cols['time'][0])
@@ -0,0 +1,51 @@
+# test_iec62056_shm.py
+# the memory mapped value table between one writer and its readers
+from iec62056_shm import iec62056_shm_writer, iec62056_shm_reader
+
+
+def test_publish_and_read(tmp_path):
+    path = str(tmp_path/'values')
+    writer = iec62056_shm_writer(path=path,capacity=8)
+    reader = iec62056_shm_reader(path=path)
+    try:
+        assert reader.get(1,'Voltage') is None
+        writer.publish(1,'Voltage',230.1,time_stamp=1000.0,unit='V')
+        writer.publish(1,'Voltage',230.2,time_stamp=1001.0,unit='V')
+        value,time_stamp,seq = reader.get(1,'Voltage')
+        assert (value,time_stamp,seq) == (230.2,1001.0,4)
+        assert list(reader.get_all()) == [('1','Voltage')]
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_writer_restart(tmp_path):
+    path = str(tmp_path/'values')
+    writer = iec62056_shm_writer(path=path,capacity=8)
+    writer.publish(1,'Active Power',100.0)
+    writer.publish(2,'Voltage',230.0)
+    reader = iec62056_shm_reader(path=path)
+    try:
+        assert reader.get(1,'Active Power')[0] == 100.0
+        assert reader.get(2,'Voltage')[0] == 230.0
+        writer.close()
+
+        #the restarted writer hands out the slots in a different order and grows the table
+        writer = iec62056_shm_writer(path=path,capacity=64)
+        writer.publish(2,'Voltage',231.0)
+        assert reader.get(1,'Active Power') is None
+        assert reader.get(2,'Voltage')[0] == 231.0
+        writer.publish(1,'Active Power',101.0)
+        assert reader.get(1,'Active Power')[0] == 101.0
+        assert reader.get_all() == {('2','Voltage'):reader.get(2,'Voltage'),('1','Active Power'):reader.get(1,'Active Power')}
+
+        #a slot index looked up before the restart is refused instead of read
+        idx = reader.slot(1,'Active Power')
+        writer.close()
+        writer = iec62056_shm_writer(path=path,capacity=8)
+        writer.publish(3,'Current',5.0)
+        assert reader.read_slot(idx) is None
+        assert reader.get(1,'Active Power') is None
+    finally:
+        reader.close()
+        writer.close()
@@ -0,0 +1,118 @@
+# test_sml.py
+# the streaming SML decoder and the gateway against encoded telegrams
+import os
+
+from sml import sml_crc16, sml_decoder, sml_gateway, sml_parse_tlv, sml_encode_tl, sml_encode_list, sml_encode_unsigned, \
+                sml_encode_octet_string, sml_encode_get_list_response, sml_encode_transport, sml_standin_stream, \
+                SML_ESCAPE, SML_TYPE_OCTET_STRING, SML_TYPE_LIST
+
+
+ENERGY = (1,0,1,8,0,255)
+POWER = (1,0,16,7,0,255)
+
+
+def make_telegram(energy=12345678,power=-250,server_id=b'\x0a\x01ESY\x11\x05\x00\x12\x34'):
+    return sml_encode_transport([sml_encode_get_list_response(server_id,[(ENERGY,30,-1,energy),(POWER,27,0,power)])])
+
+
+def test_crc16():
+    assert sml_crc16(b'123456789') == 0x906E
+
+
+def test_decode():
+    decoder = sml_decoder()
+    telegrams = decoder.feed(make_telegram())
+    assert len(telegrams) == 1
+    assert telegrams[0]['1-0:1.8.0*255'].value == 1234567.8
+    assert telegrams[0]['1-0:1.8.0*255'].unit == 'Wh'
+    assert telegrams[0]['1-0:16.7.0*255'].value == -250
+
+
+def test_crc_error():
+    t = bytearray(make_telegram())
+    t[20] ^= 0x01
+    decoder = sml_decoder()
+    assert decoder.feed(bytes(t)) == []
+    assert decoder.crc_errors == 1
+    assert len(decoder.feed(make_telegram())) == 1
+
+
+def test_escaped_escape_sequence():
+    #a 1b1b1b1b on a word boundary of the payload is sent twice, the 01010101 after it is payload and no restart
+    escaped = []
+    for fill in range(4):
+        t = make_telegram(server_id=b'\x00'*fill+b'\x01\x02'+SML_ESCAPE+b'\x01\x01\x01\x01')
+        if SML_ESCAPE+SML_ESCAPE in t:
+            escaped.append(t)
+    assert escaped
+    for t in escaped:
+        decoder = sml_decoder()
+        telegrams = decoder.feed(t)
+        assert len(telegrams) == 1
+        assert decoder.resyncs == 0
+
+
+def test_chunked_feed():
+    stream = b'\x00\xffgarbage'+b''.join([make_telegram(energy=k) for k in range(20)])
+    for size in (1,3,7,64):
+        decoder = sml_decoder()
+        telegrams = []
+        for pos in range(0,len(stream),size):
+            telegrams.extend(decoder.feed(stream[pos:pos+size]))
+        assert [t['1-0:1.8.0*255'].value for t in telegrams] == [k*0.1 for k in range(20)]
+        assert decoder.get_stats() == {'telegrams':20,'crc_errors':0,'parse_errors':0,'resyncs':0}
+
+
+def test_multi_byte_type_length():
+    assert sml_encode_tl(SML_TYPE_LIST,20) == b'\xf1\x04'
+    assert sml_encode_tl(SML_TYPE_OCTET_STRING,20) == b'\x81\x06'
+    elements = [sml_encode_unsigned(k,1) for k in range(20)]+[sml_encode_octet_string(b'x'*20)]
+    val,pos = sml_parse_tlv(sml_encode_list(elements))
+    assert val == list(range(20))+[b'x'*20]
+    values = [((1,0,k,8,0,255),30,0,k) for k in range(20)]
+    t = sml_encode_transport([sml_encode_get_list_response(b'\x01'*20,values)])
+    telegrams = sml_decoder().feed(t)
+    assert [telegrams[0]['1-0:{0}.8.0*255'.format(k)].value for k in range(20)] == list(range(20))
+
+
+def test_resync_after_lost_byte():
+    t = make_telegram()
+    stream = t+t[:40]+t[41:]+t*100
+    decoder = sml_decoder()
+    telegrams = []
+    for pos in range(0,len(stream),50):
+        telegrams.extend(decoder.feed(stream[pos:pos+50]))
+    assert len(telegrams) == 101
+    assert decoder.resyncs == 1
+
+
+def test_gateway_drops_failing_head():
+    class unplugged():
+        def __init__(self):
+            self.rfd,self.wfd = os.pipe()
+            os.write(self.wfd,b'x')
+
+        def fileno(self):
+            return self.rfd
+
+        def read(self,n):
+            raise OSError('device reports readiness to read but returned no data')
+
+        def close(self):
+            os.close(self.rfd)
+            os.close(self.wfd)
+
+    received = []
+    gw = sml_gateway()
+    stream = sml_standin_stream([make_telegram()],interval=0.001,repeat=True)
+    try:
+        gw.add_head('good',stream,on_telegram=lambda name,readings:received.append(name))
+        gw.add_head('bad',unplugged())
+        for _ in range(50):
+            gw.poll(timeout=0.1)
+            if received:
+                break
+        assert received
+        assert list(gw.get_stats()) == ['good']
+    finally:
+        stream.close()